@@ -6,15 +6,31 @@ Flask 服务端
 """
 
 import os
+import time
+import secrets
+import random
+import re
+import hashlib
+import threading
+import logging
+import shutil
+import tempfile
+import base64
 import uuid
-import json
-from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from functools import wraps
+from urllib.parse import quote, urlsplit
+from functools import lru_cache, wraps
+import httpx
+import orjson
+from cachetools import TTLCache, cached
 from flask import Flask, jsonify, request
-from supabase import create_client, Client
+from flask.json.provider import DefaultJSONProvider
+from flask_compress import Compress
+from supabase import create_client, Client, ClientOptions, PostgrestAPIError
 from dotenv import load_dotenv
-from werkzeug.utils import secure_filename
 from openai import OpenAI
 import jwt
 
@@ -23,59 +39,525 @@ BASE_DIR = Path(__file__).resolve().parent
 ENV_FILE = BASE_DIR / '.env'
 
 # 加载环境变量(明确指定 .env 文件路径)
-if ENV_FILE.exists():
-    load_dotenv(dotenv_path=ENV_FILE)
+# 依次尝试当前目录、父目录, 都没有时最后尝试默认位置
+for env_path in (ENV_FILE, BASE_DIR.parent / '.env'):
+    if env_path.is_file():
+        load_dotenv(dotenv_path=env_path)
+        break
 else:
-    # 如果当前目录没有,尝试父目录
-    parent_env = BASE_DIR.parent / '.env'
-    if parent_env.exists():
-        load_dotenv(dotenv_path=parent_env)
-    else:
-        # 最后尝试默认位置
-        load_dotenv()
+    load_dotenv()
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """
+    服务配置
+    启动时从环境变量读取一次, 之后只读
+    """
+    supabase_url: str
+    supabase_service_role_key: str
+    dashscope_api_key: str
+    port: int
+    debug: bool
+    max_upload_concurrency: int
+    ai_workers: int
+    log_level: str
+    return_raw_response: bool
+    supabase_jwt_secret: str
+    sync_clock_skew: float
+    audio_bucket: str = 'user-audio'
+
+
+CONFIG = Config(
+    supabase_url=os.getenv('SUPABASE_URL', ''),
+    supabase_service_role_key=os.getenv('SUPABASE_SERVICE_ROLE_KEY', ''),
+    dashscope_api_key=os.getenv('DASHSCOPE_API_KEY', ''),
+    port=int(os.getenv('PORT', '5001')),
+    debug=os.getenv('FLASK_DEBUG', '0') == '1',
+    max_upload_concurrency=int(os.getenv('MAX_UPLOAD_CONCURRENCY', '20')),
+    ai_workers=int(os.getenv('AI_WORKERS', '25')),
+    log_level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    # 调试用: 解析响应中附带 AI 原始输出 (单个请求也可以通过 ?debug=1 开启)
+    return_raw_response=os.getenv('RETURN_RAW', '0') == '1',
+    # 配置后在本地校验用户 JWT 签名, 不再调用 Supabase Auth 接口
+    supabase_jwt_secret=os.getenv('SUPABASE_JWT_SECRET', ''),
+    # 同步时允许的客户端时钟偏差(秒), 本地版本须比云端新出这一时长才会覆盖云端
+    sync_clock_skew=float(os.getenv('SYNC_CLOCK_SKEW', '0')),
+)
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """
+    使用 orjson 进行 JSON 序列化/反序列化
+    orjson 直接输出 UTF-8 bytes, 中文不会被转义
+    datetime 直接输出 ISO8601 字符串, 不带时区的时间按 UTC 处理, UTC 时区写作 Z
+    """
+    options = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self.options),
+            mimetype=self.mimetype
+        )
+
 
 # 初始化 Flask
+# 日志统一输出到 stderr, 格式固定便于日志系统按字段解析
+# 需在创建 Flask 应用前配置, Flask 检测到已有 handler 时不再添加自己的默认 handler
+logging.basicConfig(
+    level=CONFIG.log_level,
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+)
+# httpx 会为每个请求输出一条 INFO 日志, 只保留警告以上
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+# 响应压缩 (br / gzip), 小于 COMPRESS_MIN_SIZE (默认 500 字节) 的响应不压缩
+Compress(app)
 
 # 配置
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 最大上传 50MB
-ALLOWED_EXTENSIONS = {'m4a', 'mp3', 'wav', 'aac'}
+app.config['MAX_FORM_MEMORY_SIZE'] = 1024 * 1024  # 普通表单字段最多占用 1MB 内存, 文件部分由 Werkzeug 落盘
+ALLOWED_EXTENSIONS = frozenset({'m4a', 'mp3', 'wav', 'aac'})
+ALLOWED_EXTENSIONS_TEXT = ", ".join(sorted(ALLOWED_EXTENSIONS))
+# 扩展名对应的标准 MIME 类型 (m4a 的标准类型是 audio/mp4)
+AUDIO_MIME_TYPES = {
+    'm4a': 'audio/mp4',
+    'mp3': 'audio/mpeg',
+    'wav': 'audio/wav',
+    'aac': 'audio/aac'
+}
+# 客户端声明的 Content-Type 在此列表中时直接沿用, 否则按扩展名推断
+ALLOWED_AUDIO_MIME_TYPES = frozenset({
+    'audio/mp4',
+    'audio/x-m4a',
+    'audio/mpeg',
+    'audio/wav',
+    'audio/aac'
+})
+# 用户 ID 会拼进存储路径, 只允许安全字符 (防止 ../ 等路径注入)
+USER_ID_PATTERN = re.compile(r'\A[A-Za-z0-9_-]{1,64}\Z')
+UPLOAD_CHUNK_SIZE = 64 * 1024  # 流式上传的分块大小 64KB
+# 上传超时: 连接阶段快速失败, 避免 Storage 不可达时长时间占用 worker 线程
+UPLOAD_TIMEOUT = httpx.Timeout(60, connect=5)
+UPLOAD_MAX_RETRIES = 2  # 网络错误时的最大重试次数
+# 最近上传结果缓存: (用户ID, 内容摘要) -> 上传结果, 用于识别客户端的重复上传
+recent_uploads = TTLCache(maxsize=10_000, ttl=3600)
+recent_uploads_lock = threading.Lock()
+# 同时进行的 Storage 上传数量上限
+upload_semaphore = threading.BoundedSemaphore(CONFIG.max_upload_concurrency)
+# 异步上传 (?async=1) 的后台线程池和任务表, 任务结果保留 1 小时供客户端查询
+# 任务表只在当前进程内有效; 其他 worker 进程收到查询时, 根据任务 ID 中的存储路径检查 Storage 中的文件
+UPLOAD_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix='audio-upload')
+upload_jobs = TTLCache(maxsize=10_000, ttl=3600)
+upload_jobs_lock = threading.Lock()
+# 后台上传的最长时间(秒), 超过后 Storage 中仍没有文件即视为上传失败
+UPLOAD_JOB_MAX_AGE = 600
+# 存储路径 (用户ID/文件名) 的格式, 与 build_audio_storage_path 生成的一致
+STORAGE_PATH_PATTERN = re.compile(r'\A[A-Za-z0-9_-]{1,64}/[A-Za-z0-9_-]+\.[a-z0-9]+\Z')
+
+# 外部 HTTP 服务建立连接失败时的重试次数
+HTTP_CONNECT_RETRIES = 2
+# 数据库请求遇到网络错误或服务暂时不可用时的最大重试次数
+DB_MAX_RETRIES = 2
+# 可以重试的 PostgREST 错误: 网关错误 (响应不是 JSON 时错误码为 HTTP 状态码) 和数据库连接失败
+RETRYABLE_DB_ERROR_CODES = frozenset({502, 503, 504, 'PGRST000', 'PGRST001', 'PGRST002'})
+# 可以确定请求没有在数据库执行的错误: 连接没有建立, 或 PostgREST 无法连接数据库
+DB_NOT_EXECUTED_ERROR_CODES = frozenset({'PGRST000', 'PGRST001', 'PGRST002'})
+DB_NOT_EXECUTED_TRANSPORT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
 
 # 初始化 Supabase 客户端
-SUPABASE_URL = os.getenv('SUPABASE_URL')
-SUPABASE_SERVICE_ROLE_KEY = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
-
-if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
-    error_msg = "请在 .env 文件中配置 SUPABASE_URL 和 SUPABASE_SERVICE_ROLE_KEY\n"
-    error_msg += f"\n.env 文件应该位于: {ENV_FILE}\n"
-    error_msg += f"\n.env 文件格式示例:\n"
-    error_msg += "SUPABASE_URL=https://your-project.supabase.co\n"
-    error_msg += "SUPABASE_SERVICE_ROLE_KEY=your-service-role-key-here\n"
-    error_msg += f"\n当前工作目录: {os.getcwd()}\n"
-    error_msg += f"脚本所在目录: {BASE_DIR}\n"
+if not CONFIG.supabase_url or not CONFIG.supabase_service_role_key:
+    error_lines = [
+        "请在 .env 文件中配置 SUPABASE_URL 和 SUPABASE_SERVICE_ROLE_KEY",
+        "",
+        f".env 文件应该位于: {ENV_FILE}",
+        "",
+        ".env 文件格式示例:",
+        "SUPABASE_URL=https://your-project.supabase.co",
+        "SUPABASE_SERVICE_ROLE_KEY=your-service-role-key-here",
+        "",
+        f"当前工作目录: {os.getcwd()}",
+        f"脚本所在目录: {BASE_DIR}",
+    ]
     if ENV_FILE.exists():
-        error_msg += f"\n⚠️  找到 .env 文件,但环境变量未加载,请检查文件格式"
+        error_lines += ["", "⚠️  找到 .env 文件,但环境变量未加载,请检查文件格式"]
+    error_msg = "\n".join(error_lines) + "\n"
     raise ValueError(error_msg)
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+# 共享的 HTTP 连接池: Storage / PostgREST / Auth 子客户端复用同一组 keep-alive 连接,
+# 避免每次请求重新建立 TCP + TLS 握手
+# 建立连接失败时由传输层自动重试 (只重试连接阶段, 请求不会被重复发送)
+# 空闲连接保留 60 秒 (httpx 默认 5 秒), 请求间隔稍长时也不必重新握手
+supabase_http_client = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=60),
+        retries=HTTP_CONNECT_RETRIES,
+    ),
+    timeout=30,
+)
+
+# Storage REST 接口地址 (直接流式上传、拼接公开 URL 时使用)
+SUPABASE_STORAGE_URL = f"{CONFIG.supabase_url.rstrip('/')}/storage/v1"
+
+supabase: Client = create_client(
+    CONFIG.supabase_url,
+    CONFIG.supabase_service_role_key,
+    options=ClientOptions(httpx_client=supabase_http_client),
+)
+
+# 音频 bucket 的文件操作对象, 复用而不是每次调用 from_() 重新创建
+audio_bucket = supabase.storage.from_(CONFIG.audio_bucket)
 
 # 初始化阿里云 DashScope 客户端
+AI_CALL_TIMEOUT = 60  # 单次 AI 调用的最长等待时间(秒)
+AI_MAX_RETRIES = 2  # AI 调用失败时的最大重试次数
+# 一次解析 (含全部重试) 的总时间上限, 需小于 gunicorn 的 worker 超时 (120 秒)
+AI_TOTAL_TIMEOUT = 100
+AI_MIN_ATTEMPT_TIME = 10  # 剩余时间少于此值(秒)时不再发起重试
+
 dashscope_client = None
-DASHSCOPE_API_KEY = os.getenv('DASHSCOPE_API_KEY')
 
-if DASHSCOPE_API_KEY:
+if CONFIG.dashscope_api_key:
     dashscope_client = OpenAI(
-        api_key=DASHSCOPE_API_KEY,
+        api_key=CONFIG.dashscope_api_key,
         base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
+        # 复用 keep-alive 连接, 避免每次调用都重新进行 TLS 握手
+        http_client=httpx.Client(
+            transport=httpx.HTTPTransport(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+                retries=HTTP_CONNECT_RETRIES,
+            ),
+            timeout=AI_CALL_TIMEOUT,
+        ),
+        # 重试由 call_dashscope 统一控制, 关闭 SDK 自带的重试, 避免超时后在后台线程中继续重试
+        max_retries=0,
     )
-    print("✅ 阿里云 DashScope 客户端初始化成功")
+    app.logger.info("✅ 阿里云 DashScope 客户端初始化成功")
 else:
-    print("⚠️  未配置 DASHSCOPE_API_KEY，语音解析功能将不可用")
+    app.logger.warning("⚠️  未配置 DASHSCOPE_API_KEY，语音解析功能将不可用")
+
+# DashScope 调用专用线程池: 限制同时发往 AI 服务的请求数,
+# 并为每次调用设置硬性超时, 避免慢请求无限期占用 Web 工作线程
+AI_POOL = ThreadPoolExecutor(max_workers=CONFIG.ai_workers, thread_name_prefix='dashscope')
+# 正在进行中的 AI 解析, 按 (音频 URL, 分类列表) 合并并发的相同请求
+inflight_parses = {}
+inflight_parses_lock = threading.Lock()
+# 最近解析成功的 AI 返回内容, 按 (音频 URL, 分类列表) 缓存 10 分钟
+recent_parses = TTLCache(maxsize=512, ttl=600)
+recent_parses_lock = threading.Lock()
 
 
 def allowed_file(filename):
-    """检查文件扩展名是否允许"""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    """
+    检查文件扩展名是否允许
+
+    返回:
+        - (是否允许, 小写扩展名)
+    """
+    _, sep, ext = filename.rpartition('.')
+    ext = ext.lower()
+    return bool(sep) and ext in ALLOWED_EXTENSIONS, ext
+
+
+def upload_audio_stream(storage_path, stream, content_type):
+    """
+    以流式方式把音频上传到 Supabase Storage (user-audio bucket)
+
+    直接调用 Storage REST 接口, 按 UPLOAD_CHUNK_SIZE 分块读取文件流并发送,
+    内存占用只有一个分块大小, 与文件大小无关
+
+    返回:
+        - 上传的字节数
+    """
+    uploaded = [0]
+
+    def iter_chunks():
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            uploaded[0] += len(chunk)
+            yield chunk
+
+    # 网络错误时重试 (需要文件流可以回到开头重新读取, 原始请求体流不支持)
+    can_retry = is_seekable_stream(stream)
+    retry_count = 0
+
+    # 限制同时进行的上传数量, 避免突发流量压垮 Storage 连接
+    with upload_semaphore:
+        while True:
+            try:
+                response = supabase_http_client.post(
+                    f"{SUPABASE_STORAGE_URL}/object/{CONFIG.audio_bucket}/{quote(storage_path)}",
+                    content=iter_chunks(),
+                    headers={
+                        'Authorization': f'Bearer {CONFIG.supabase_service_role_key}',
+                        'apikey': CONFIG.supabase_service_role_key,
+                        'Content-Type': content_type,
+                        'Cache-Control': 'max-age=3600',
+                        'x-upsert': 'false'
+                    },
+                    timeout=UPLOAD_TIMEOUT
+                )
+                break
+            except httpx.NetworkError as network_error:
+                retry_count += 1
+                if not can_retry or retry_count > UPLOAD_MAX_RETRIES:
+                    raise
+                app.logger.warning("上传失败,正在重试 (%d/%d): %s", retry_count, UPLOAD_MAX_RETRIES, network_error)
+                time.sleep(backoff_delay(retry_count))
+                stream.seek(0)
+                uploaded[0] = 0
+
+    if response.is_error:
+        raise httpx.HTTPStatusError(
+            f'{response.status_code} {response.reason_phrase}: {response.text}',
+            request=response.request,
+            response=response
+        )
+
+    return uploaded[0]
+
+
+def backoff_delay(retry_count, base_delay=0.5):
+    """
+    第 retry_count 次重试前的等待时间: 指数退避 (0.5s, 1s, 2s ...) 并加上 ±20% 随机抖动,
+    避免大量请求在服务降级时同时重试
+    """
+    return base_delay * 2 ** (retry_count - 1) * random.uniform(0.8, 1.2)
+
+
+def is_db_error_not_executed(db_error):
+    """判断数据库请求出错时是否可以确定没有执行: 连接没有建立, 或 PostgREST 返回了明确的错误"""
+    if isinstance(db_error, httpx.TransportError):
+        return isinstance(db_error, DB_NOT_EXECUTED_TRANSPORT_ERRORS)
+    if isinstance(db_error, PostgrestAPIError):
+        return db_error.code not in RETRYABLE_DB_ERROR_CODES - DB_NOT_EXECUTED_ERROR_CODES
+    return True
+
+
+def execute_with_retry(query, replay_safe=True):
+    """
+    执行 Supabase 数据库查询, 网络错误或数据库暂时不可用时按指数退避重试
+    本服务的数据库操作 (查询、upsert、按 ID 更新/删除) 重复执行结果相同, 可以安全重试
+    replay_safe 为 False 时 (重复执行会改变返回结果, 如同步函数), 只在请求确定没有执行时重试
+    """
+    retry_count = 0
+    while True:
+        try:
+            return query.execute()
+        except (httpx.TransportError, PostgrestAPIError) as db_error:
+            if isinstance(db_error, PostgrestAPIError) and db_error.code not in RETRYABLE_DB_ERROR_CODES:
+                raise
+            if not replay_safe and not is_db_error_not_executed(db_error):
+                raise
+            retry_count += 1
+            if retry_count > DB_MAX_RETRIES:
+                raise
+            app.logger.warning("数据库请求失败,正在重试 (%d/%d): %s", retry_count, DB_MAX_RETRIES, db_error)
+            time.sleep(backoff_delay(retry_count))
+
+
+def is_seekable_stream(stream):
+    """判断文件流能否回到开头重新读取 (WSGI 服务器提供的原始请求体流通常不行)"""
+    return hasattr(stream, 'seekable') and stream.seekable()
+
+
+def hash_audio_stream(stream):
+    """计算文件流内容的 BLAKE2b 摘要, 读取完成后回到文件开头"""
+    hasher = hashlib.blake2b(digest_size=16)
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        hasher.update(chunk)
+    stream.seek(0)
+    return hasher.hexdigest()
+
+
+def build_audio_storage_path(user_id, file_ext):
+    """
+    生成唯一的音频文件名及其在 user-audio bucket 中的存储路径
+
+    返回:
+        - (文件名, 存储路径)
+    """
+    timestamp = time.strftime('%Y%m%d_%H%M%S')
+    unique_id = secrets.token_hex(4)
+    filename = f"{user_id}_{timestamp}_{unique_id}.{file_ext}"
+    return filename, f"{user_id}/{filename}"
+
+
+def encode_upload_job_id(storage_path):
+    """
+    生成异步上传任务 ID: 包含存储路径和创建时间, 任何 worker 进程都能据此查询上传结果
+    """
+    return base64.urlsafe_b64encode(orjson.dumps([storage_path, int(time.time())])).decode()
+
+
+def decode_upload_job_id(job_id):
+    """
+    解析异步上传任务 ID, 返回 (存储路径, 创建时间)
+    格式不正确时返回 None
+    """
+    try:
+        storage_path, created_at = orjson.loads(base64.urlsafe_b64decode(job_id))
+    except Exception:
+        return None
+    if not isinstance(storage_path, str) or not STORAGE_PATH_PATTERN.match(storage_path):
+        return None
+    if not isinstance(created_at, int):
+        return None
+    return storage_path, created_at
+
+
+def find_uploaded_audio(storage_path):
+    """
+    查询 Storage 中是否已有该文件 (HEAD 请求, 不下载内容)
+
+    返回:
+        - 文件存在时返回与上传结果相同格式的数据, 否则返回 None
+    """
+    response = supabase_http_client.head(
+        f"{SUPABASE_STORAGE_URL}/object/authenticated/{CONFIG.audio_bucket}/{quote(storage_path)}",
+        headers={
+            'Authorization': f'Bearer {CONFIG.supabase_service_role_key}',
+            'apikey': CONFIG.supabase_service_role_key
+        },
+        timeout=UPLOAD_TIMEOUT
+    )
+    if response.status_code != 200:
+        return None
+
+    return {
+        'url': get_audio_public_url(storage_path),
+        'filename': storage_path.rsplit('/', 1)[1],
+        'path': storage_path,
+        'size': int(response.headers.get('Content-Length', 0)),
+        'content_type': response.headers.get('Content-Type')
+    }
+
+
+def get_audio_public_url(storage_path):
+    """获取 user-audio bucket 中文件的公开 URL (纯字符串拼接, 不需要网络请求)"""
+    return f"{SUPABASE_STORAGE_URL}/object/public/{CONFIG.audio_bucket}/{quote(storage_path)}"
+
+
+def run_upload_job(storage_path, filename, stream, content_type, upload_key=None):
+    """
+    把音频流上传到 Storage 并生成返回给客户端的上传结果 (同步上传和后台上传任务共用)
+
+    返回:
+        - 上传结果 (url / filename / path / size / content_type)
+    """
+    file_size = upload_audio_stream(storage_path, stream, content_type)
+
+    upload_data = {
+        'url': get_audio_public_url(storage_path),
+        'filename': filename,
+        'path': storage_path,
+        'size': file_size,
+        'content_type': content_type
+    }
+    if upload_key:
+        with recent_uploads_lock:
+            recent_uploads[upload_key] = upload_data
+    return upload_data
+
+
+def run_background_upload(storage_path, filename, spool, content_type, upload_key=None):
+    """
+    后台上传任务: 上传转存的临时文件, 结束后关闭 (删除) 临时文件
+    """
+    with spool:
+        return run_upload_job(storage_path, filename, spool, content_type, upload_key)
+
+
+def describe_upload_error(upload_error):
+    """
+    把上传异常转换为返回给客户端的错误信息
+
+    返回:
+        - (错误信息, HTTP 状态码)
+    """
+    error_msg = str(upload_error)
+    error_code = 500
+
+    # 检查是否是权限错误 (403)
+    if '403' in error_msg or 'Forbidden' in error_msg or 'permission' in error_msg.lower() or 'access denied' in error_msg.lower():
+        error_code = 403
+        error_msg = (
+            "权限不足 (403 Forbidden)\n\n"
+            "请检查 Supabase Storage 配置:\n"
+            "1. Supabase Storage bucket 'user-audio' 是否存在\n"
+            "2. Service Role Key 是否正确配置\n"
+            "3. Storage bucket 权限设置是否正确(建议设置为公开或允许服务角色访问)\n"
+            "4. Storage Policies 是否允许上传操作\n\n"
+            "详细配置指南请查看: SUPABASE_STORAGE_SETUP.md"
+        )
+
+    return error_msg, error_code
+
+
+# 固定内容的响应体只在启动时序列化一次
+HELLO_RESPONSE_BODY = orjson.dumps({
+    'message': 'VoiceAccount Server',
+    'status': 'success',
+    'version': '1.0.0'
+})
+API_HELLO_RESPONSE_BODY = orjson.dumps({
+    'message': 'hello flask',
+    'version': '1.0.0',
+    'service': 'VoiceAccount API'
+})
+HEALTH_RESPONSE_BODY = orjson.dumps({
+    'status': 'healthy',
+    'service': 'flask'
+})
+# 内容固定的路由, 允许客户端和代理缓存
+CACHEABLE_PATHS = frozenset({'/', '/api/hello', '/health'})
+CACHEABLE_MAX_AGE = 60
+
+
+@app.after_request
+def add_cache_headers(response):
+    """
+    为内容固定的路由添加 Cache-Control 头
+    """
+    if request.path in CACHEABLE_PATHS and response.status_code == 200:
+        response.cache_control.public = True
+        response.cache_control.max_age = CACHEABLE_MAX_AGE
+    return response
+
+
+def require_json(f):
+    """
+    装饰器: 要求请求体是非空的 JSON 对象
+    解析结果由 Flask 缓存, 视图函数中再读取 request.json 不会重复解析
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        data = request.get_json(silent=True)
+        if not data or not isinstance(data, dict):
+            return jsonify({
+                'status': 'error',
+                'message': '请求数据为空'
+            }), 400
+
+        return f(*args, **kwargs)
+
+    return decorated_function
 
 
 @app.route('/')
@@ -83,11 +565,7 @@ def hello():
     """
     根路由 - 返回欢迎信息
     """
-    return jsonify({
-        'message': 'VoiceAccount Server',
-        'status': 'success',
-        'version': '1.0.0'
-    })
+    return app.response_class(HELLO_RESPONSE_BODY, mimetype='application/json')
 
 
 @app.route('/api/hello')
@@ -95,11 +573,7 @@ def api_hello():
     """
     API 路由 - 返回 hello 信息
     """
-    return jsonify({
-        'message': 'hello flask',
-        'version': '1.0.0',
-        'service': 'VoiceAccount API'
-    })
+    return app.response_class(API_HELLO_RESPONSE_BODY, mimetype='application/json')
 
 
 @app.route('/health')
@@ -107,10 +581,17 @@ def health_check():
     """
     健康检查路由
     """
-    return jsonify({
-        'status': 'healthy',
-        'service': 'flask'
-    })
+    return app.response_class(HEALTH_RESPONSE_BODY, mimetype='application/json')
+
+
+@cached(cache=TTLCache(maxsize=1, ttl=30), lock=threading.Lock())
+def get_user_count():
+    """
+    获取用户数量 (结果缓存 30 秒)
+    admin API 会拉取完整的用户列表, 开销较大, 避免每次请求都调用
+    """
+    response = supabase.auth.admin.list_users()
+    return len(response) if response else 0
 
 
 @app.route('/supabase-test')
@@ -120,11 +601,8 @@ def supabase_test():
     获取用户数量
     """
     try:
-        # 使用 admin API 获取用户列表
-        response = supabase.auth.admin.list_users()
-
-        # 获取用户数量
-        user_count = len(response) if response else 0
+        # 使用 admin API 获取用户数量
+        user_count = get_user_count()
 
         return jsonify({
             'status': 'success',
@@ -139,88 +617,109 @@ def supabase_test():
         }), 500
 
 
-@app.route('/storage-test')
-def storage_test():
+# Storage 检测中可以并行执行的网络请求使用的线程池
+PROBE_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix='storage-probe')
+
+
+def probe_storage_upload(test_path):
     """
-    Supabase Storage 测试
-    测试 Storage bucket 是否可访问和上传
+    向 Storage 上传一个小的测试文件
+
+    返回:
+        - 上传失败时返回错误信息, 成功返回 None
     """
     try:
-        bucket_name = 'user-audio'
+        audio_bucket.upload(
+            path=test_path,
+            file=b'test audio file',
+            file_options={
+                'content-type': 'text/plain',
+                'upsert': 'true'
+            }
+        )
+        return None
+    except Exception as e:
+        return str(e)
 
-        # 测试 1: 检查 bucket 是否存在
-        try:
-            buckets = supabase.storage.list_buckets()
-            bucket_names = [bucket.name for bucket in buckets] if buckets else []
-            bucket_exists = bucket_name in bucket_names
-        except Exception as e:
-            return jsonify({
-                'status': 'error',
-                'message': f'无法列出 buckets: {str(e)}',
-                'check': '请检查 Service Role Key 是否正确'
-            }), 500
 
-        if not bucket_exists:
-            return jsonify({
-                'status': 'error',
-                'message': f'Bucket "{bucket_name}" 不存在',
-                'solution': f'请在 Supabase Dashboard 中创建名为 "{bucket_name}" 的 Storage bucket'
-            }), 404
+@cached(cache=TTLCache(maxsize=1, ttl=60), lock=threading.Lock())
+def run_storage_probe():
+    """
+    执行 Storage 检测 (列出 bucket、上传并删除测试文件、获取公开 URL)
+    结果缓存 60 秒, 避免监控频繁访问时每次都对 Supabase 发起多次网络请求
 
-        # 测试 2: 尝试上传一个小文件
-        test_content = b'test audio file'
-        test_path = 'test/test_upload.txt'
-        upload_success = False
-        upload_error = None
+    返回:
+        - (响应数据, HTTP 状态码)
+    """
+    bucket_name = CONFIG.audio_bucket
+    test_path = 'test/test_upload.txt'
 
-        try:
-            upload_response = supabase.storage.from_(bucket_name).upload(
-                path=test_path,
-                file=test_content,
-                file_options={
-                    'content-type': 'text/plain',
-                    'upsert': 'true'
-                }
-            )
-            upload_success = True
+    # 测试 2 (上传测试文件) 与测试 1 互不依赖, 提前在后台线程中开始
+    upload_future = PROBE_POOL.submit(probe_storage_upload, test_path)
 
-            # 清理测试文件
-            try:
-                supabase.storage.from_(bucket_name).remove([test_path])
-            except:
-                pass  # 忽略删除错误
+    # 测试 1: 检查 bucket 是否存在
+    try:
+        buckets = supabase.storage.list_buckets()
+        bucket_names = [bucket.name for bucket in buckets] if buckets else []
+        bucket_exists = bucket_name in bucket_names
+    except Exception as e:
+        return {
+            'status': 'error',
+            'message': f'无法列出 buckets: {str(e)}',
+            'check': '请检查 Service Role Key 是否正确'
+        }, 500
 
-        except Exception as e:
-            upload_error = str(e)
-            error_code = 500
-            if '403' in upload_error or 'Forbidden' in upload_error:
-                error_code = 403
-
-        # 测试 3: 尝试获取公开 URL
-        url_test = False
-        url_error = None
-        try:
-            test_url = supabase.storage.from_(bucket_name).get_public_url(test_path)
-            url_test = True
-        except Exception as e:
-            url_error = str(e)
+    if not bucket_exists:
+        return {
+            'status': 'error',
+            'message': f'Bucket "{bucket_name}" 不存在',
+            'solution': f'请在 Supabase Dashboard 中创建名为 "{bucket_name}" 的 Storage bucket'
+        }, 404
 
-        return jsonify({
-            'status': 'success' if upload_success else 'error',
-            'message': 'Storage 测试完成',
-            'bucket_exists': bucket_exists,
-            'bucket_name': bucket_name,
-            'upload_test': 'success' if upload_success else 'failed',
-            'upload_error': upload_error,
-            'url_test': 'success' if url_test else 'failed',
-            'url_error': url_error,
-            'solution': (
-                '如果上传失败,请检查:\n'
-                '1. Storage bucket 权限设置为公开 (Public)\n'
-                '2. 或者设置 Storage Policies 允许服务角色访问\n'
-                '3. 在 Supabase Dashboard > Storage > Policies 中配置'
-            ) if not upload_success else None
-        }), 200 if upload_success else 403
+    # 测试 2: 等待上传结果
+    upload_error = upload_future.result()
+    upload_success = upload_error is None
+
+    if upload_success:
+        # 清理测试文件, 不等待结果 (忽略删除错误)
+        PROBE_POOL.submit(audio_bucket.remove, [test_path])
+
+    # 测试 3: 尝试获取公开 URL
+    url_test = False
+    url_error = None
+    try:
+        test_url = audio_bucket.get_public_url(test_path)
+        url_test = True
+    except Exception as e:
+        url_error = str(e)
+
+    return {
+        'status': 'success' if upload_success else 'error',
+        'message': 'Storage 测试完成',
+        'bucket_exists': bucket_exists,
+        'bucket_name': bucket_name,
+        'upload_test': 'success' if upload_success else 'failed',
+        'upload_error': upload_error,
+        'url_test': 'success' if url_test else 'failed',
+        'url_error': url_error,
+        'solution': (
+            '如果上传失败,请检查:\n'
+            '1. Storage bucket 权限设置为公开 (Public)\n'
+            '2. 或者设置 Storage Policies 允许服务角色访问\n'
+            '3. 在 Supabase Dashboard > Storage > Policies 中配置'
+        ) if not upload_success else None
+    }, 200 if upload_success else 403
+
+
+@app.route('/storage-test')
+def storage_test():
+    """
+    Supabase Storage 测试
+    测试 Storage bucket 是否可访问和上传
+    """
+    try:
+        payload, status_code = run_storage_probe()
+        return jsonify(payload), status_code
 
     except Exception as e:
         return jsonify({
@@ -230,338 +729,610 @@ def storage_test():
         }), 500
 
 
+def has_request_body():
+    """请求是否带有请求体 (声明了非零长度, 或使用分块传输)"""
+    if request.content_length is not None:
+        return request.content_length > 0
+    return 'chunked' in request.headers.get('Transfer-Encoding', '').lower()
+
+
+def is_raw_audio_mimetype(mimetype):
+    """原始请求体上传模式接受的 Content-Type: audio/* 或 application/octet-stream"""
+    return mimetype.startswith('audio/') or mimetype == 'application/octet-stream'
+
+
 @app.route('/api/upload-audio', methods=['POST'])
 def upload_audio():
     """
     接收录音文件并上传到 Supabase Storage
 
-    请求参数:
-        - file: 音频文件 (multipart/form-data)
+    请求参数 (multipart/form-data):
+        - file: 音频文件
         - user_id: 用户ID (可选)
 
+    也支持直接把音频作为请求体上传 (Content-Type 为 audio/* 或 application/octet-stream,
+    其他类型返回 415), 此时请求体不经过表单解析, 直接转发到 Supabase Storage:
+        - X-Filename 请求头 或 filename 查询参数: 原始文件名
+        - X-User-Id 请求头 或 user_id 查询参数: 用户ID (可选)
+
+    请求体为 JSON ({"filename", "user_id", "content_type"}) 时不上传音频,
+    与 /api/upload-audio/init 相同, 返回签名上传 URL 由客户端直接上传
+
+    查询参数 async=1 时在后台上传, 立即返回 202 和 job_id,
+    之后通过 /api/upload-audio/status/<job_id> 查询结果
+
     返回:
         - success: 上传成功,返回文件 URL
+        - accepted: 异步上传已开始,返回任务 ID
         - error: 上传失败,返回错误信息
     """
     try:
-        # 检查是否有文件
-        if 'file' not in request.files:
+        # JSON 请求只申请签名上传 URL, 音频由客户端直接上传到 Storage
+        if request.is_json:
+            return init_audio_upload()
+
+        # 声明的请求体大小超限时直接拒绝, 不读取也不解析请求体
+        if request.content_length and request.content_length > app.config['MAX_CONTENT_LENGTH']:
             return jsonify({
                 'status': 'error',
-                'message': '没有找到文件'
-            }), 400
+                'message': '文件过大,最大支持 50MB'
+            }), 413
 
-        file = request.files['file']
+        if request.mimetype == 'multipart/form-data':
+            # 检查是否有文件
+            if 'file' not in request.files:
+                return jsonify({
+                    'status': 'error',
+                    'message': '没有找到文件'
+                }), 400
+
+            file = request.files['file']
+            original_filename = file.filename
+            audio_stream = file.stream
+            client_mimetype = file.mimetype
+
+            # 获取用户 ID (可选)
+            user_id = request.form.get('user_id', 'anonymous')
+        else:
+            # 没有请求体, 或是不带文件的表单: 与 multipart 缺少 file 字段相同处理
+            if not has_request_body() or request.mimetype in ('', 'application/x-www-form-urlencoded'):
+                return jsonify({
+                    'status': 'error',
+                    'message': '没有找到文件'
+                }), 400
+
+            if not is_raw_audio_mimetype(request.mimetype):
+                return jsonify({
+                    'status': 'error',
+                    'message': '不支持的 Content-Type,请使用 multipart/form-data、audio/* 或 application/octet-stream'
+                }), 415
+
+            # 原始请求体模式: 从客户端连接读取的数据直接转发, 不做表单解析和落盘
+            original_filename = request.headers.get('X-Filename') or request.args.get('filename', '')
+            audio_stream = request.stream
+            client_mimetype = request.mimetype
+
+            # 获取用户 ID (可选)
+            user_id = request.headers.get('X-User-Id') or request.args.get('user_id', 'anonymous')
+
+        # 检查用户 ID (会拼进存储路径)
+        if not USER_ID_PATTERN.match(user_id):
+            return jsonify({
+                'status': 'error',
+                'message': '无效的用户ID'
+            }), 400
 
         # 检查文件名是否为空
-        if file.filename == '':
+        if not original_filename:
             return jsonify({
                 'status': 'error',
                 'message': '文件名为空'
             }), 400
 
         # 检查文件类型
-        if not allowed_file(file.filename):
+        is_allowed, file_ext = allowed_file(original_filename)
+        if not is_allowed:
             return jsonify({
                 'status': 'error',
-                'message': f'不支持的文件类型,仅支持: {", ".join(ALLOWED_EXTENSIONS)}'
+                'message': f'不支持的文件类型,仅支持: {ALLOWED_EXTENSIONS_TEXT}'
             }), 400
 
-        # 获取用户 ID (可选)
-        user_id = request.form.get('user_id', 'anonymous')
+        # 同一用户重复上传相同内容 (如弱网下客户端重试) 时, 直接返回之前的上传结果
+        # 只对可以回退的文件流 (multipart 上传) 生效
+        upload_key = None
+        if is_seekable_stream(audio_stream):
+            upload_key = (user_id, hash_audio_stream(audio_stream))
+            with recent_uploads_lock:
+                previous_upload = recent_uploads.get(upload_key)
+            if previous_upload:
+                return jsonify({
+                    'status': 'success',
+                    'message': '文件上传成功',
+                    'data': previous_upload
+                }), 200
 
-        # 生成唯一文件名
-        file_ext = file.filename.rsplit('.', 1)[1].lower()
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        unique_id = str(uuid.uuid4())[:8]
-        filename = f"{user_id}_{timestamp}_{unique_id}.{file_ext}"
+        # 生成唯一文件名和存储路径
+        # bucket 名称: user-audio
+        filename, storage_path = build_audio_storage_path(user_id, file_ext)
+        if client_mimetype in ALLOWED_AUDIO_MIME_TYPES:
+            content_type = client_mimetype
+        else:
+            content_type = AUDIO_MIME_TYPES[file_ext]
 
-        # 读取文件内容
-        file_content = file.read()
+        # 异步模式: 请求体先转存到本地临时文件, 上传在后台线程中进行, 立即返回 202 和任务 ID
+        # 客户端通过 /api/upload-audio/status/<job_id> 查询上传结果
+        if request.args.get('async') == '1':
+            spool = tempfile.TemporaryFile()
+            try:
+                shutil.copyfileobj(audio_stream, spool, UPLOAD_CHUNK_SIZE)
+                spool.seek(0)
+            except Exception:
+                spool.close()
+                raise
+
+            job_id = encode_upload_job_id(storage_path)
+            future = UPLOAD_POOL.submit(
+                run_background_upload, storage_path, filename, spool, content_type, upload_key
+            )
+            with upload_jobs_lock:
+                upload_jobs[job_id] = future
 
-        # 上传到 Supabase Storage
-        # bucket 名称: user-audio
-        storage_path = f"{user_id}/{filename}"
+            return jsonify({
+                'status': 'accepted',
+                'message': '文件已接收,正在上传',
+                'data': {
+                    'job_id': job_id,
+                    'status_url': f'/api/upload-audio/status/{job_id}',
+                    'url': get_audio_public_url(storage_path),
+                    'filename': filename,
+                    'path': storage_path,
+                    'content_type': content_type
+                }
+            }), 202
 
-        # 上传文件
+        # 流式上传文件 (不把整个文件读入内存)
         try:
-            upload_response = supabase.storage.from_('user-audio').upload(
-                path=storage_path,
-                file=file_content,
-                file_options={
-                    'content-type': f'audio/{file_ext}',
-                    'cache-control': '3600',
-                    'upsert': 'false'
-                }
-            )
+            upload_data = run_upload_job(storage_path, filename, audio_stream, content_type, upload_key)
         except Exception as upload_error:
-            error_msg = str(upload_error)
-            error_code = 500
-
-            # 检查是否是权限错误 (403)
-            if '403' in error_msg or 'Forbidden' in error_msg or 'permission' in error_msg.lower() or 'access denied' in error_msg.lower():
-                error_code = 403
-                error_msg = (
-                    "权限不足 (403 Forbidden)\n\n"
-                    "请检查 Supabase Storage 配置:\n"
-                    "1. Supabase Storage bucket 'user-audio' 是否存在\n"
-                    "2. Service Role Key 是否正确配置\n"
-                    "3. Storage bucket 权限设置是否正确(建议设置为公开或允许服务角色访问)\n"
-                    "4. Storage Policies 是否允许上传操作\n\n"
-                    "详细配置指南请查看: SUPABASE_STORAGE_SETUP.md"
-                )
-
+            error_msg, error_code = describe_upload_error(upload_error)
             return jsonify({
                 'status': 'error',
                 'message': error_msg,
                 'error_code': error_code
             }), error_code
 
-        # 获取公开 URL
+        return jsonify({
+            'status': 'success',
+            'message': '文件上传成功',
+            'data': upload_data
+        }), 200
+
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': '文件上传失败',
+            'error': str(e)
+        }), 500
+
+
+@app.route('/api/upload-audio/status/<job_id>', methods=['GET'])
+def upload_audio_status(job_id):
+    """
+    查询异步上传任务 (/api/upload-audio?async=1) 的结果
+
+    任务由本进程执行时直接读取任务结果; 由其他 worker 进程执行时,
+    根据任务 ID 中的存储路径检查 Storage 中是否已有文件 (此时无法得到具体的失败原因)
+
+    返回:
+        - pending: 仍在上传
+        - success: 上传成功,返回文件 URL
+        - error: 上传失败或任务不存在
+    """
+    with upload_jobs_lock:
+        future = upload_jobs.get(job_id)
+
+    if future is None:
+        job = decode_upload_job_id(job_id)
+        if job is None:
+            return jsonify({
+                'status': 'error',
+                'message': '上传任务不存在或已过期'
+            }), 404
+
+        storage_path, created_at = job
+        try:
+            upload_data = find_uploaded_audio(storage_path)
+        except Exception as e:
+            return jsonify({
+                'status': 'error',
+                'message': '查询上传结果失败',
+                'error': str(e)
+            }), 500
+
+        if upload_data is not None:
+            return jsonify({
+                'status': 'success',
+                'message': '文件上传成功',
+                'data': upload_data
+            }), 200
+
+        if time.time() - created_at < UPLOAD_JOB_MAX_AGE:
+            return jsonify({
+                'status': 'pending',
+                'message': '文件正在上传'
+            }), 200
+
+        return jsonify({
+            'status': 'error',
+            'message': '上传失败或任务已过期'
+        }), 404
+
+    if not future.done():
+        return jsonify({
+            'status': 'pending',
+            'message': '文件正在上传'
+        }), 200
+
+    upload_error = future.exception()
+    if upload_error is not None:
+        error_msg, error_code = describe_upload_error(upload_error)
+        return jsonify({
+            'status': 'error',
+            'message': error_msg,
+            'error_code': error_code
+        }), error_code
+
+    return jsonify({
+        'status': 'success',
+        'message': '文件上传成功',
+        'data': future.result()
+    }), 200
+
+
+@app.route('/api/upload-audio/init', methods=['POST'])
+@require_json
+def init_audio_upload():
+    """
+    生成 Supabase Storage 签名上传 URL, 客户端直接把音频 PUT 到 Storage,
+    音频数据不再经过本服务
+
+    请求体:
+    {
+        "filename": "recording.m4a",
+        "user_id": "uuid" (可选),
+        "content_type": "audio/mp4" (可选)
+    }
+
+    返回:
+        - upload_url: 签名上传 URL (客户端使用 PUT 上传文件)
+        - token: 签名令牌
+        - url: 上传完成后的文件公开 URL
+        - filename / path: 生成的文件名和存储路径
+    """
+    try:
+        data = request.json
+
+        original_filename = data.get('filename')
+        if not original_filename:
+            return jsonify({
+                'status': 'error',
+                'message': '文件名为空'
+            }), 400
+
+        # 检查文件类型
+        is_allowed, file_ext = allowed_file(original_filename)
+        if not is_allowed:
+            return jsonify({
+                'status': 'error',
+                'message': f'不支持的文件类型,仅支持: {ALLOWED_EXTENSIONS_TEXT}'
+            }), 400
+
+        user_id = data.get('user_id') or 'anonymous'
+        if not isinstance(user_id, str) or not USER_ID_PATTERN.match(user_id):
+            return jsonify({
+                'status': 'error',
+                'message': '无效的用户ID'
+            }), 400
+
+        content_type = data.get('content_type')
+        if content_type not in ALLOWED_AUDIO_MIME_TYPES:
+            content_type = AUDIO_MIME_TYPES[file_ext]
+
+        filename, storage_path = build_audio_storage_path(user_id, file_ext)
+
+        signed = audio_bucket.create_signed_upload_url(storage_path)
+
+        return jsonify({
+            'status': 'success',
+            'message': '上传地址生成成功',
+            'data': {
+                'upload_url': signed['signed_url'],
+                'token': signed['token'],
+                'url': get_audio_public_url(storage_path),
+                'filename': filename,
+                'path': storage_path,
+                'content_type': content_type
+            }
+        }), 200
+
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': '生成上传地址失败',
+            'error': str(e)
+        }), 500
+
+
+# ==========================================
+# 日期解析
+# ==========================================
+
+# 时间描述 -> (小时, 分钟), 按顺序匹配, 命中第一个即停止
+TIME_PATTERNS = (
+    (re.compile(r'(\d{1,2}):(\d{2})'), lambda m: (int(m.group(1)), int(m.group(2)))),
+    (re.compile(r'(\d{1,2})点'), lambda m: (int(m.group(1)), 0)),
+    (re.compile(r'上午|早上|早晨|早'), lambda m: (9, 0)),
+    (re.compile(r'中午|午间|正午'), lambda m: (12, 0)),
+    (re.compile(r'下午|午后'), lambda m: (15, 0)),
+    (re.compile(r'晚上|傍晚|晚'), lambda m: (19, 0)),
+    (re.compile(r'夜里|深夜|半夜'), lambda m: (22, 0)),
+)
+
+# 中文日期格式
+CN_DATE_YMD_PATTERN = re.compile(r'(\d{4})年(\d{1,2})月(\d{1,2})[日号]')       # 2024年1月14日 / 2024年1月14号
+CN_DATE_MD_PATTERN = re.compile(r'(\d{1,2})月(\d{1,2})[日号]')                   # 1月14日 / 1月14号
+CN_DATE_MD_NO_SUFFIX_PATTERN = re.compile(r'(\d{1,2})月(\d{1,2})(?![日号])')     # 1月14
+CN_DATE_D_PATTERN = re.compile(r'(\d{1,2})[日号]')                                # 14号 / 14日
+# 按优先级排列的中文日期格式, 每个格式的分组依次为 [年, ]月, 日 或 日
+CN_DATE_FORMATS = (
+    CN_DATE_YMD_PATTERN,
+    CN_DATE_MD_PATTERN,
+    CN_DATE_MD_NO_SUFFIX_PATTERN,
+    CN_DATE_D_PATTERN,
+)
+# 以上格式都至少包含其中一个字符, 都不包含时可以直接跳过
+CN_DATE_CHARS = frozenset('年月日号')
+
+# 相对日期描述 -> 相对今天的天数偏移
+RELATIVE_DATE_OFFSETS = {
+    '大前天': -3, '大前日': -3,
+    '大后天': 3, '大后日': 3,
+    '前天': -2, '前日': -2,
+    '后天': 2, '后日': 2,
+    '昨天': -1, '昨日': -1,
+    '明天': 1, '明日': 1,
+    '今天': 0, '今日': 0,
+}
+# 单字写法只在整个描述就是这个字时生效
+RELATIVE_DATE_SINGLE_CHAR_OFFSETS = {'昨': -1, '明': 1, '今': 0}
+RELATIVE_DATE_PATTERN = re.compile(
+    '|'.join(map(re.escape, sorted(RELATIVE_DATE_OFFSETS, key=len, reverse=True)))
+)
+
+# 标准日期格式: 先用正则预筛选, 只对形状匹配的格式调用 strptime, 避免反复抛出 ValueError
+_DASH_DATE = r'\d{4}-\d{1,2}-\d{1,2}'
+_SLASH_YMD = r'\d{4}/\d{1,2}/\d{1,2}'
+_SLASH_DMY = r'\d{1,2}/\d{1,2}/\d{4}'
+_TIME = r'\d{1,2}:\d{1,2}:\d{1,2}'
+DATE_FORMATS = (
+    (re.compile(rf'{_DASH_DATE}T{_TIME}\Z'), '%Y-%m-%dT%H:%M:%S'),
+    (re.compile(rf'{_DASH_DATE}T{_TIME}\.\d+\Z'), '%Y-%m-%dT%H:%M:%S.%f'),
+    (re.compile(rf'{_DASH_DATE} {_TIME}\Z'), '%Y-%m-%d %H:%M:%S'),
+    (re.compile(rf'{_DASH_DATE} {_TIME}\.\d+\Z'), '%Y-%m-%d %H:%M:%S.%f'),
+    (re.compile(rf'{_DASH_DATE}\Z'), '%Y-%m-%d'),
+    (re.compile(rf'{_SLASH_YMD} {_TIME}\Z'), '%Y/%m/%d %H:%M:%S'),
+    (re.compile(rf'{_SLASH_YMD}\Z'), '%Y/%m/%d'),
+    (re.compile(rf'{_SLASH_DMY} {_TIME}\Z'), '%m/%d/%Y %H:%M:%S'),
+    (re.compile(rf'{_SLASH_DMY}\Z'), '%m/%d/%Y'),
+    (re.compile(rf'{_SLASH_DMY} {_TIME}\Z'), '%d/%m/%Y %H:%M:%S'),
+    (re.compile(rf'{_SLASH_DMY}\Z'), '%d/%m/%Y'),
+)
+
+
+def extract_time(date_str):
+    """
+    从日期描述中提取时间部分 (按 TIME_PATTERNS 顺序, 命中第一个即停止)
+
+    返回:
+        - (小时, 分钟), 没有时间信息时返回 None
+    """
+    for pattern, extractor in TIME_PATTERNS:
+        match = pattern.search(date_str)
+        if match:
+            return extractor(match)
+    return None
+
+
+@lru_cache(maxsize=2048)
+def match_chinese_date(date_str):
+    """
+    分析中文日期格式（如"2024年1月14日"、"1月15日"、"1月14号"等）, 只依赖字符串本身, 结果按字符串缓存
+
+    返回:
+        - (时间部分 (时, 分) 或 None, 候选日期元组)
+        - 候选日期为 (年, 月, 日), 缺少的年/月为 None, 按下列格式顺序排列:
+          1. "2024年1月14日" 或 "2024年1月14号"
+          2. "1月14日" 或 "1月14号" (没有年份，使用当前年份)
+          3. "1月14" (没有"日"或"号")
+          4. "14号" 或 "14日" (只有日期，使用当前年月)
+    """
+    if CN_DATE_CHARS.isdisjoint(date_str):
+        return None, ()
+
+    candidates = []
+    for pattern in CN_DATE_FORMATS:
+        # 只有日期的格式 (如"14号") 只在没有提到月份时使用
+        if pattern is CN_DATE_D_PATTERN and '月' in date_str:
+            continue
+        match = pattern.search(date_str)
+        if match:
+            numbers = tuple(int(group) for group in match.groups())
+            candidates.append((None,) * (3 - len(numbers)) + numbers)
+
+    return extract_time(date_str), tuple(candidates)
+
+
+def parse_chinese_date(date_str, current_time):
+    """解析中文日期格式（如"2024年1月14日"、"1月15日"、"1月14号"等）"""
+    if not isinstance(date_str, str):
+        return None
+
+    time_part, candidates = match_chinese_date(date_str)
+
+    # 依次尝试各个候选日期, 日期无效时尝试下一个
+    for year, month, day in candidates:
+        try:
+            if year is not None:
+                date_value = datetime(year, month, day)
+            elif month is not None:
+                year = current_time.year
+                date_value = datetime(year, month, day)
+                # 如果日期已经过去（在当前日期之前超过30天），可能是明年
+                if date_value < current_time - timedelta(days=30):
+                    date_value = datetime(year + 1, month, day)
+            else:
+                year = current_time.year
+                month = current_time.month
+                date_value = datetime(year, month, day)
+                # 如果日期已经过去超过7天，可能是下个月
+                if date_value < current_time - timedelta(days=7):
+                    if month == 12:
+                        date_value = datetime(year + 1, 1, day)
+                    else:
+                        date_value = datetime(year, month + 1, day)
+            if time_part:
+                date_value = date_value.replace(hour=time_part[0], minute=time_part[1], second=0, microsecond=0)
+            return date_value
+        except ValueError:
+            continue
+
+    return None
+
+
+@lru_cache(maxsize=1024)
+def match_relative_date(date_str):
+    """
+    分析中文相对日期描述, 只依赖字符串本身, 结果按字符串缓存
+
+    返回:
+        - (日期偏移天数, 时间部分 (时, 分) 或 None), 不是相对日期描述时返回 None
+    """
+    date_str_lower = date_str.lower().strip()
+
+    # 提取时间部分（如果有）
+    time_part = extract_time(date_str_lower)
+
+    # 计算日期偏移（一次正则扫描, 长词优先, 避免"前天"误匹配"大前天"）
+    match = RELATIVE_DATE_PATTERN.search(date_str_lower)
+    if match:
+        date_offset = RELATIVE_DATE_OFFSETS[match.group(0)]
+    else:
+        date_offset = RELATIVE_DATE_SINGLE_CHAR_OFFSETS.get(date_str_lower)
+
+    if date_offset is None:
+        return None  # 不是相对日期描述
+
+    return date_offset, time_part
+
+
+def parse_relative_date(date_str, current_time):
+    """解析中文相对日期描述，转换为实际日期"""
+    if not isinstance(date_str, str):
+        return None
+
+    matched = match_relative_date(date_str)
+    if matched is None:
+        return None
+
+    date_offset, time_part = matched
+
+    # 计算目标日期
+    target_date = current_time + timedelta(days=date_offset)
+
+    # 如果有时间信息，更新时间部分; 没有则保持当前时间
+    if time_part:
+        target_date = target_date.replace(hour=time_part[0], minute=time_part[1], second=0, microsecond=0)
+
+    return target_date
+
+
+@lru_cache(maxsize=1024)
+def parse_standard_date(date_str):
+    """解析标准日期格式 (优先 ISO8601, 其余格式按 DATE_FORMATS 依次尝试), 结果与当前时间无关, 按字符串缓存"""
+    try:
+        return datetime.fromisoformat(date_str)
+    except ValueError:
+        pass
+
+    for pattern, fmt in DATE_FORMATS:
+        if not pattern.match(date_str):
+            continue
         try:
-            public_url = supabase.storage.from_('user-audio').get_public_url(storage_path)
-        except Exception as url_error:
-            return jsonify({
-                'status': 'error',
-                'message': f'获取文件 URL 失败: {str(url_error)}'
-            }), 500
+            return datetime.strptime(date_str, fmt)
+        except ValueError:
+            continue
 
-        return jsonify({
-            'status': 'success',
-            'message': '文件上传成功',
-            'data': {
-                'url': public_url,
-                'filename': filename,
-                'path': storage_path,
-                'size': len(file_content),
-                'content_type': f'audio/{file_ext}'
-            }
-        }), 200
+    return None
 
-    except Exception as e:
-        return jsonify({
-            'status': 'error',
-            'message': '文件上传失败',
-            'error': str(e)
-        }), 500
 
+# AI 返回内容外层的 markdown 代码块 (```json ... ``` 或 ``` ... ```), 缺少结尾标记时取到末尾
+CODE_FENCE_PATTERN = re.compile(r'```(?:json)?\s*(.*?)(?:```|\Z)', re.S)
 
-@app.route('/api/parse-voice', methods=['POST'])
-def parse_voice():
-    """
-    使用 AI 解析语音内容，提取记账明细
 
-    请求参数:
-        - audio_url: 语音文件URL
-        - categories: 用户自定义的分类列表
+def clean_parsed_item(item, current_time):
+    """
+    把 AI 返回的一条记账条目整理为标准格式
 
     返回:
-        - 解析出的记账条目数组 (金额/标题/分类)
+        - 包含 amount / title / category / date (ISO8601 字符串) 的字典
     """
+    # 处理日期字段
+    date_value = current_time  # 默认使用当前时间
+    if 'date' in item:
+        date_str = item.get('date')
+        try:
+            if isinstance(date_str, str):
+                # 解析顺序：
+                # 1. 首先尝试解析中文相对日期描述（如"昨天"、"前天"等）
+                # 2. 然后尝试解析中文日期格式（如"2024年1月14日"、"1月15日"等）
+                # 3. 最后尝试解析标准日期格式（ISO8601等）, 解析失败时使用当前时间
+                date_value = (
+                    parse_relative_date(date_str, current_time)
+                    or parse_chinese_date(date_str, current_time)
+                    or parse_standard_date(date_str)
+                    or current_time
+                )
+            elif isinstance(date_str, (int, float)):
+                # 如果是时间戳
+                date_value = datetime.fromtimestamp(date_str)
+        except Exception as e:
+            # 解析失败，使用当前时间
+            app.logger.debug("日期解析错误: %s, 原始值: %s", e, date_str)
+            date_value = current_time
+
     try:
-        # 检查 DashScope 客户端是否已初始化
-        if not dashscope_client:
-            return jsonify({
-                'status': 'error',
-                'message': '语音解析服务未配置，请联系管理员'
-            }), 503
+        amount = float(item.get('amount', 0))
+    except (TypeError, ValueError):
+        amount = 0.0
+
+    return {
+        'amount': amount,
+        'title': str(item.get('title', '未命名支出')),
+        'category': str(item.get('category', '其他')),
+        'date': date_value.isoformat()  # 转换为 ISO8601 格式字符串
+    }
 
-        # 获取请求数据
-        data = request.json
-        if not data:
-            return jsonify({
-                'status': 'error',
-                'message': '请求数据为空'
-            }), 400
 
-        audio_url = data.get('audio_url')
-        categories = data.get('categories', [])
+def get_audio_format(audio_url):
+    """
+    根据音频 URL 路径中的扩展名确定传给 AI 服务的音频格式 (无法识别时默认 m4a)
+    """
+    is_allowed, file_ext = allowed_file(urlsplit(audio_url).path)
+    return file_ext if is_allowed else 'm4a'
 
-        if not audio_url:
-            return jsonify({
-                'status': 'error',
-                'message': '缺少音频URL参数'
-            }), 400
 
-        # 构建分类提示文本
-        category_text = ""
-        if categories:
-            category_text = f"\n可用的分类包括：{', '.join(categories)}"
-
-        # 添加日期解析辅助函数
-        def parse_chinese_date(date_str, current_time):
-            """解析中文日期格式（如"2024年1月14日"、"1月15日"、"1月14号"等）"""
-            if not isinstance(date_str, str):
-                return None
-            
-            import re
-            from datetime import datetime, timedelta
-            
-            # 提取时间部分（如果有）
-            time_part = None
-            hour = current_time.hour
-            minute = current_time.minute
-            
-            # 检查是否包含时间信息
-            time_patterns = [
-                (r'(\d{1,2}):(\d{2})', lambda m: (int(m.group(1)), int(m.group(2)))),
-                (r'(\d{1,2})点', lambda m: (int(m.group(1)), 0)),
-                (r'上午|早上|早晨|早', lambda m: (9, 0)),
-                (r'中午|午间|正午', lambda m: (12, 0)),
-                (r'下午|午后', lambda m: (15, 0)),
-                (r'晚上|傍晚|晚', lambda m: (19, 0)),
-                (r'夜里|深夜|半夜', lambda m: (22, 0)),
-            ]
-            
-            for pattern, extractor in time_patterns:
-                match = re.search(pattern, date_str)
-                if match:
-                    try:
-                        hour, minute = extractor(match)
-                        time_part = (hour, minute)
-                        break
-                    except:
-                        pass
-            
-            # 尝试解析中文日期格式
-            # 格式1: "2024年1月14日" 或 "2024年1月14号"
-            match = re.search(r'(\d{4})年(\d{1,2})月(\d{1,2})[日号]', date_str)
-            if match:
-                try:
-                    year = int(match.group(1))
-                    month = int(match.group(2))
-                    day = int(match.group(3))
-                    date_value = datetime(year, month, day)
-                    if time_part:
-                        date_value = date_value.replace(hour=time_part[0], minute=time_part[1], second=0, microsecond=0)
-                    return date_value
-                except ValueError:
-                    pass
-            
-            # 格式2: "1月14日" 或 "1月14号" (没有年份，使用当前年份)
-            match = re.search(r'(\d{1,2})月(\d{1,2})[日号]', date_str)
-            if match:
-                try:
-                    year = current_time.year
-                    month = int(match.group(1))
-                    day = int(match.group(2))
-                    date_value = datetime(year, month, day)
-                    # 如果日期已经过去（在当前日期之前超过30天），可能是明年
-                    if date_value < current_time - timedelta(days=30):
-                        date_value = datetime(year + 1, month, day)
-                    if time_part:
-                        date_value = date_value.replace(hour=time_part[0], minute=time_part[1], second=0, microsecond=0)
-                    return date_value
-                except ValueError:
-                    pass
-            
-            # 格式3: "1月14" (没有"日"或"号")
-            match = re.search(r'(\d{1,2})月(\d{1,2})(?![日号])', date_str)
-            if match:
-                try:
-                    year = current_time.year
-                    month = int(match.group(1))
-                    day = int(match.group(2))
-                    date_value = datetime(year, month, day)
-                    if date_value < current_time - timedelta(days=30):
-                        date_value = datetime(year + 1, month, day)
-                    if time_part:
-                        date_value = date_value.replace(hour=time_part[0], minute=time_part[1], second=0, microsecond=0)
-                    return date_value
-                except ValueError:
-                    pass
-            
-            # 格式4: "14号" 或 "14日" (只有日期，使用当前年月)
-            match = re.search(r'(\d{1,2})[日号]', date_str)
-            if match and '月' not in date_str:
-                try:
-                    year = current_time.year
-                    month = current_time.month
-                    day = int(match.group(1))
-                    date_value = datetime(year, month, day)
-                    # 如果日期已经过去超过7天，可能是下个月
-                    if date_value < current_time - timedelta(days=7):
-                        if month == 12:
-                            date_value = datetime(year + 1, 1, day)
-                        else:
-                            date_value = datetime(year, month + 1, day)
-                    if time_part:
-                        date_value = date_value.replace(hour=time_part[0], minute=time_part[1], second=0, microsecond=0)
-                    return date_value
-                except ValueError:
-                    pass
-            
-            return None
-        
-        def parse_relative_date(date_str, current_time):
-            """解析中文相对日期描述，转换为实际日期"""
-            if not isinstance(date_str, str):
-                return None
-            
-            date_str_lower = date_str.lower().strip()
-            from datetime import timedelta
-            import re
-            
-            # 提取时间部分（如果有）
-            time_part = None
-            hour = current_time.hour
-            minute = current_time.minute
-            
-            # 检查是否包含时间信息
-            time_patterns = [
-                (r'(\d{1,2}):(\d{2})', lambda m: (int(m.group(1)), int(m.group(2)))),
-                (r'(\d{1,2})点', lambda m: (int(m.group(1)), 0)),
-                (r'上午|早上|早晨|早', lambda m: (9, 0)),
-                (r'中午|午间|正午', lambda m: (12, 0)),
-                (r'下午|午后', lambda m: (15, 0)),
-                (r'晚上|傍晚|晚', lambda m: (19, 0)),
-                (r'夜里|深夜|半夜', lambda m: (22, 0)),
-            ]
-            
-            for pattern, extractor in time_patterns:
-                match = re.search(pattern, date_str_lower)
-                if match:
-                    try:
-                        hour, minute = extractor(match)
-                        time_part = (hour, minute)
-                        break  # 找到时间就停止
-                    except:
-                        pass
-            
-            # 计算日期偏移（按优先级顺序检查，避免误匹配）
-            date_offset = None
-            if '大前天' in date_str_lower or '大前日' in date_str_lower:
-                date_offset = -3
-            elif '大后天' in date_str_lower or '大后日' in date_str_lower:
-                date_offset = 3
-            elif '前天' in date_str_lower or '前日' in date_str_lower:
-                date_offset = -2
-            elif '后天' in date_str_lower or '后日' in date_str_lower:
-                date_offset = 2
-            elif '昨天' in date_str_lower or '昨日' in date_str_lower or date_str_lower == '昨':
-                date_offset = -1
-            elif '明天' in date_str_lower or '明日' in date_str_lower or date_str_lower == '明':
-                date_offset = 1
-            elif '今天' in date_str_lower or '今日' in date_str_lower or date_str_lower == '今':
-                date_offset = 0
-            
-            if date_offset is None:
-                return None  # 不是相对日期描述
-            
-            # 计算目标日期
-            target_date = current_time + timedelta(days=date_offset)
-            
-            # 如果有时间信息，更新时间部分
-            if time_part:
-                target_date = target_date.replace(hour=time_part[0], minute=time_part[1], second=0, microsecond=0)
-            else:
-                # 如果没有时间信息，保持当前时间
-                pass
-            
-            return target_date
-        
-        # 构建系统提示词 - 优化版
-        system_prompt = f"""你是一个专业的智能记账助手,专门从语音中精确提取记账信息。
+# 系统提示词模板 - 优化版, {category_text} 处填入可用分类
+SYSTEM_PROMPT_TEMPLATE = """你是一个专业的智能记账助手,专门从语音中精确提取记账信息。
 
 **核心任务**:
 1. 仔细分析语音内容,识别所有消费记录
@@ -614,165 +1385,228 @@ def parse_voice():
 - 金额必须是数字类型,不能是字符串
 - date使用相对描述,不要用绝对日期"""
 
-        # 调用阿里云语音识别API (带重试机制)
-        max_retries = 2
-        retry_count = 0
-        last_error = None
 
-        while retry_count <= max_retries:
-            try:
-                completion = dashscope_client.chat.completions.create(
-                    model="qwen-audio-turbo",  # 使用最新的多模态模型
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": system_prompt
-                        },
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "input_audio",
-                                    "input_audio": {
-                                        "data": audio_url,
-                                        "format": "m4a",  # 修正格式为实际的m4a
-                                    },
+@lru_cache(maxsize=256)
+def build_system_prompt(categories):
+    """
+    根据分类列表 (tuple) 生成系统提示词, 结果按分类列表缓存
+    """
+    # 构建分类提示文本
+    category_text = ""
+    if categories:
+        category_text = f"\n可用的分类包括：{', '.join(categories)}"
+    return SYSTEM_PROMPT_TEMPLATE.format(category_text=category_text)
+
+
+def is_retryable_ai_error(api_error):
+    """
+    判断 AI 调用失败后是否值得重试
+    音频格式错误、4xx 客户端错误之类的确定性失败重试也不会成功, 直接返回错误
+    (请求超时 408 和限流 429 除外)
+    """
+    status_code = getattr(api_error, 'status_code', None)
+    if status_code is not None and 400 <= status_code < 500 and status_code not in (408, 429):
+        return False
+    return 'format' not in str(api_error).lower()
+
+
+def call_dashscope(audio_url, categories):
+    """
+    调用阿里云 DashScope 解析语音中的记账信息 (带重试机制)
+
+    返回:
+        - AI 返回的文本内容, 重试次数用完后抛出最后一次的异常
+    """
+    # 构建系统提示词 (相同分类列表复用缓存结果)
+    system_prompt = build_system_prompt(categories)
+    retry_count = 0
+    deadline = time.monotonic() + AI_TOTAL_TIMEOUT
+
+    while True:
+        # 每次调用的超时不超过剩余的总时间
+        attempt_timeout = min(AI_CALL_TIMEOUT, deadline - time.monotonic())
+        future = None
+        try:
+            future = AI_POOL.submit(
+                dashscope_client.chat.completions.create,
+                model="qwen-audio-turbo",  # 使用最新的多模态模型
+                messages=[
+                    {
+                        "role": "system",
+                        "content": system_prompt
+                    },
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "input_audio",
+                                "input_audio": {
+                                    "data": audio_url,
+                                    "format": get_audio_format(audio_url),
                                 },
-                                {"type": "text", "text": "请分析这段语音中的记账信息。注意:1)准确识别金额数字 2)理解消费场景 3)准确提取时间信息。返回JSON格式的记账条目。"},
-                            ],
-                        },
-                    ],
-                    # 只需要文本输出
-                    modalities=["text"],
-                    stream=False,
-                    temperature=0.1,  # 降低温度以提高准确性和一致性
-                    top_p=0.8,        # 降低top_p以提高确定性
-                )
+                            },
+                            {"type": "text", "text": "请分析这段语音中的记账信息。注意:1)准确识别金额数字 2)理解消费场景 3)准确提取时间信息。返回JSON格式的记账条目。"},
+                        ],
+                    },
+                ],
+                # 只需要文本输出
+                modalities=["text"],
+                stream=False,
+                temperature=0.1,  # 降低温度以提高准确性和一致性
+                top_p=0.8,        # 降低top_p以提高确定性
+                # 线程中的 HTTP 请求与等待同时超时, 超时的调用不会继续占用线程池
+                timeout=attempt_timeout,
+            )
+            completion = future.result(timeout=attempt_timeout)
+
+            # 获取AI返回的内容
+            return completion.choices[0].message.content
+
+        except Exception as api_error:
+            # 等待超时时, 还在线程池中排队的调用直接取消
+            if future is not None:
+                future.cancel()
+            retry_count += 1
+            delay = backoff_delay(retry_count)
+            if (
+                retry_count > AI_MAX_RETRIES
+                or not is_retryable_ai_error(api_error)
+                or deadline - time.monotonic() - delay < AI_MIN_ATTEMPT_TIME
+            ):
+                raise
+            app.logger.warning("API调用失败,正在重试 (%d/%d): %s", retry_count, AI_MAX_RETRIES, api_error)
+            time.sleep(delay)
+
+
+def request_ai_parse(audio_url, categories):
+    """
+    解析语音, 同一音频 + 分类列表的并发请求合并为一次 AI 调用, 其余请求等待并共享结果
 
-                # 获取AI返回的内容
-                ai_response = completion.choices[0].message.content
-                break  # 成功则跳出重试循环
+    返回:
+        - AI 返回的文本内容
+    """
+    parse_key = (audio_url, categories)
+    with inflight_parses_lock:
+        future = inflight_parses.get(parse_key)
+        is_owner = future is None
+        if is_owner:
+            future = Future()
+            inflight_parses[parse_key] = future
+
+    if is_owner:
+        try:
+            future.set_result(call_dashscope(audio_url, categories))
+        except Exception as api_error:
+            future.set_exception(api_error)
+        except BaseException as interrupt:
+            # 当前请求被中断 (如 gevent 超时 / greenlet 被终止) 时也要结束共享的 Future,
+            # 否则等待同一结果的其他请求会一直阻塞; 中断异常本身只在当前请求中继续抛出
+            future.set_exception(RuntimeError(f'AI 解析被中断: {interrupt!r}'))
+            raise
+        finally:
+            with inflight_parses_lock:
+                del inflight_parses[parse_key]
 
-            except Exception as api_error:
-                last_error = api_error
-                retry_count += 1
-                if retry_count <= max_retries:
-                    print(f"API调用失败,正在重试 ({retry_count}/{max_retries}): {str(api_error)}")
-                    import time
-                    time.sleep(1)  # 等待1秒后重试
-                else:
-                    return jsonify({
-                        'status': 'error',
-                        'message': f'AI服务调用失败(已重试{max_retries}次): {str(last_error)}'
-                    }), 500
+    return future.result()
+
+
+@app.route('/api/parse-voice', methods=['POST'])
+@require_json
+def parse_voice():
+    """
+    使用 AI 解析语音内容，提取记账明细
+
+    请求参数:
+        - audio_url: 语音文件URL
+        - categories: 用户自定义的分类列表
+
+    返回:
+        - 解析出的记账条目数组 (金额/标题/分类)
+    """
+    try:
+        # 检查 DashScope 客户端是否已初始化
+        if not dashscope_client:
+            return jsonify({
+                'status': 'error',
+                'message': '语音解析服务未配置，请联系管理员'
+            }), 503
+
+        # 获取请求数据
+        data = request.json
+
+        audio_url = data.get('audio_url')
+        categories = data.get('categories') or []
+        return_raw = CONFIG.return_raw_response or request.args.get('debug') == '1'
+
+        if not audio_url:
+            return jsonify({
+                'status': 'error',
+                'message': '缺少音频URL参数'
+            }), 400
+
+        if not isinstance(categories, list) or not all(isinstance(category, str) for category in categories):
+            return jsonify({
+                'status': 'error',
+                'message': 'categories 必须是字符串列表'
+            }), 400
+
+        # 同一音频 + 分类列表的 AI 返回结果会缓存一段时间, 客户端重试时不再重复调用 AI 服务
+        parse_key = (audio_url, tuple(categories))
+        with recent_parses_lock:
+            ai_response = recent_parses.get(parse_key)
+
+        if ai_response is None:
+            try:
+                ai_response = request_ai_parse(audio_url, parse_key[1])
+            except Exception as last_error:
+                return jsonify({
+                    'status': 'error',
+                    'message': f'AI服务调用失败(已重试{AI_MAX_RETRIES}次): {str(last_error)}'
+                }), 500
 
         # 尝试解析JSON
         try:
             # 清理可能的markdown代码块标记
-            if '```json' in ai_response:
-                ai_response = ai_response.split('```json')[1].split('```')[0].strip()
-            elif '```' in ai_response:
-                ai_response = ai_response.split('```')[1].split('```')[0].strip()
+            fence_match = CODE_FENCE_PATTERN.search(ai_response)
+            if fence_match:
+                ai_response = fence_match.group(1).strip()
 
-            parsed_items = json.loads(ai_response)
+            parsed_items = orjson.loads(ai_response)
 
             # 确保返回的是数组
             if not isinstance(parsed_items, list):
                 parsed_items = [parsed_items]
 
-            # 验证和清理数据
-            cleaned_items = []
-            from datetime import datetime
+            # 验证和清理数据 (非字典条目直接丢弃)
             current_time = datetime.now()
+            cleaned_items = [clean_parsed_item(item, current_time) for item in parsed_items if isinstance(item, dict)]
 
-            for item in parsed_items:
-                if isinstance(item, dict):
-                    # 处理日期字段
-                    date_value = current_time  # 默认使用当前时间
-                    if 'date' in item:
-                        try:
-                            # 尝试解析 ISO8601 格式的日期
-                            date_str = item.get('date')
-                            if isinstance(date_str, str):
-                                # 解析顺序：
-                                # 1. 首先尝试解析中文相对日期描述（如"昨天"、"前天"等）
-                                # 2. 然后尝试解析中文日期格式（如"2024年1月14日"、"1月15日"等）
-                                # 3. 最后尝试解析标准日期格式（ISO8601等）
-
-                                relative_date = parse_relative_date(date_str, current_time)
-                                if relative_date:
-                                    date_value = relative_date
-                                else:
-                                    # 尝试解析中文日期格式
-                                    chinese_date = parse_chinese_date(date_str, current_time)
-                                    if chinese_date:
-                                        date_value = chinese_date
-                                    else:
-                                        # 尝试多种标准日期格式
-                                        date_formats = [
-                                            '%Y-%m-%dT%H:%M:%S',
-                                            '%Y-%m-%dT%H:%M:%S.%f',
-                                            '%Y-%m-%d %H:%M:%S',
-                                            '%Y-%m-%d %H:%M:%S.%f',
-                                            '%Y-%m-%d',
-                                            '%Y/%m/%d %H:%M:%S',
-                                            '%Y/%m/%d',
-                                            '%m/%d/%Y %H:%M:%S',
-                                            '%m/%d/%Y',
-                                            '%d/%m/%Y %H:%M:%S',
-                                            '%d/%m/%Y',
-                                        ]
-                                        parsed = False
-                                        for fmt in date_formats:
-                                            try:
-                                                date_value = datetime.strptime(date_str, fmt)
-                                                parsed = True
-                                                break
-                                            except ValueError:
-                                                continue
-                                        if not parsed:
-                                            # 如果解析失败，使用当前时间
-                                            date_value = current_time
-                            elif isinstance(date_str, (int, float)):
-                                # 如果是时间戳
-                                date_value = datetime.fromtimestamp(date_str)
-                        except Exception as e:
-                            # 解析失败，使用当前时间
-                            print(f"日期解析错误: {e}, 原始值: {date_str}")
-                            date_value = current_time
-
-                    cleaned_item = {
-                        'amount': float(item.get('amount', 0)),
-                        'title': str(item.get('title', '未命名支出')),
-                        'category': str(item.get('category', '其他')),
-                        'date': date_value.isoformat()  # 转换为 ISO8601 格式字符串
-                    }
-                    cleaned_items.append(cleaned_item)
-
-            # 确保所有条目都有日期字段（如果没有，使用当前时间）
-            for item in cleaned_items:
-                if 'date' not in item:
-                    item['date'] = current_time.isoformat()
-
-            return jsonify({
+            result = {
                 'status': 'success',
                 'message': '语音解析成功',
-                'data': cleaned_items,
-                'raw_response': ai_response  # 可选：返回原始响应用于调试
-            }), 200
+                'data': cleaned_items
+            }
+            if return_raw:
+                result['raw_response'] = ai_response  # 调试用: 返回原始响应
 
-        except json.JSONDecodeError as e:
+            with recent_parses_lock:
+                recent_parses[parse_key] = ai_response
+            return jsonify(result), 200
+
+        except orjson.JSONDecodeError as e:
             # 如果解析失败，尝试提取关键信息
-            return jsonify({
+            result = {
                 'status': 'partial_success',
                 'message': '语音识别成功，但数据格式需要调整',
                 'data': [{
                     'amount': 0,
                     'title': '请手动编辑',
                     'category': '其他'
-                }],
-                'raw_response': ai_response
-            }), 200
+                }]
+            }
+            if return_raw:
+                result['raw_response'] = ai_response
+            return jsonify(result), 200
 
     except Exception as e:
         return jsonify({
@@ -785,6 +1619,48 @@ def parse_voice():
 # JWT Authentication Middleware
 # ==========================================
 
+# 已验证的用户令牌缓存: blake2b(token) -> (用户 ID, 邮箱, 令牌过期时间)
+# 缓存 5 分钟, 期间同一令牌不再请求 Supabase Auth
+AUTH_CACHE_TTL = 300
+auth_cache = TTLCache(maxsize=10_000, ttl=AUTH_CACHE_TTL)
+auth_cache_lock = threading.Lock()
+
+
+def verify_access_token(token):
+    """
+    验证用户的 JWT 令牌
+    配置了 SUPABASE_JWT_SECRET 时在本地校验签名, 否则调用 Supabase Auth 接口, 结果按令牌缓存
+
+    返回:
+        - (用户 ID, 邮箱), 令牌无效时返回 None
+    """
+    token_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    with auth_cache_lock:
+        cached_user = auth_cache.get(token_key)
+    if cached_user and cached_user[2] > time.time():
+        return cached_user[0], cached_user[1]
+
+    if CONFIG.supabase_jwt_secret:
+        claims = jwt.decode(
+            token,
+            CONFIG.supabase_jwt_secret,
+            algorithms=['HS256'],
+            audience='authenticated'
+        )
+        user_id, user_email, expires_at = claims['sub'], claims.get('email'), claims['exp']
+    else:
+        user = supabase.auth.get_user(token).user
+        if not user:
+            return None
+        # 令牌已由 Supabase 验证, 这里只读取过期时间, 缓存不会超过令牌本身的有效期
+        claims = jwt.decode(token, options={'verify_signature': False})
+        user_id, user_email, expires_at = str(user.id), user.email, claims.get('exp', 0)
+
+    with auth_cache_lock:
+        auth_cache[token_key] = (user_id, user_email, expires_at)
+    return user_id, user_email
+
+
 def require_auth(f):
     """
     装饰器: 验证 JWT token 并提取用户 ID
@@ -811,10 +1687,9 @@ def require_auth(f):
 
             token = parts[1]
 
-            # 使用 Supabase 验证 JWT
+            # 验证 JWT
             try:
-                user_response = supabase.auth.get_user(token)
-                user = user_response.user
+                user = verify_access_token(token)
 
                 if not user:
                     return jsonify({
@@ -823,8 +1698,7 @@ def require_auth(f):
                     }), 401
 
                 # 将用户 ID 添加到 request 对象中
-                request.user_id = str(user.id)
-                request.user_email = user.email
+                request.user_id, request.user_email = user
 
             except Exception as e:
                 return jsonify({
@@ -847,8 +1721,191 @@ def require_auth(f):
 # Sync Endpoints
 # ==========================================
 
+SYNC_BATCH_SIZE = 500  # 每次 upsert 的最大记录数, 避免请求体过大或超时
+SYNC_LOOKUP_BATCH_SIZE = 100  # 每次按 ID 查询的最大数量, ID 列表放在 URL 中, 不宜过长
+# 同步的记录必须包含的字段, 缺少任一字段的记录会被跳过
+REQUIRED_EXPENSE_FIELDS = frozenset({'id', 'amount', 'title', 'category', 'expense_date'})
+SYNC_CLOCK_SKEW = timedelta(seconds=CONFIG.sync_clock_skew)
+# 调用不存在的数据库函数时 PostgREST / Postgres 返回的错误码
+SYNC_RPC_MISSING_CODES = frozenset({'PGRST202', '42883'})
+# 数据库中是否部署了 sync_expenses 函数 (见 database_setup.sql)
+sync_rpc_available = True
+
+# 拉取接口的分页参数: 传入 limit 时按 (updated_at, id) 倒序做游标分页
+FETCH_MAX_LIMIT = 1000
+EXPENSE_ID_PATTERN = re.compile(r'\A[A-Za-z0-9_-]{1,64}\Z')
+
+
+@lru_cache(maxsize=4096)
+def parse_timestamp(value):
+    """
+    解析 ISO8601 时间戳, 支持末尾的 Z (UTC)
+    同一批同步数据中常有相同的时间戳, 结果会被缓存 (datetime 不可变, 可以安全共享)
+    """
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    return datetime.fromisoformat(value)
+
+
+def encode_fetch_cursor(row):
+    """根据当前页最后一条记录生成下一页游标 (对客户端不透明)"""
+    return base64.urlsafe_b64encode(orjson.dumps([row['updated_at'], row['id']])).decode()
+
+
+def decode_fetch_cursor(cursor):
+    """
+    解析分页游标, 返回 (updated_at, id)
+    游标格式不正确时返回 None
+    """
+    try:
+        updated_at, expense_id = orjson.loads(base64.urlsafe_b64decode(cursor))
+        updated_at = parse_timestamp(updated_at).isoformat()
+    except Exception:
+        return None
+    if not isinstance(expense_id, str) or not EXPENSE_ID_PATTERN.match(expense_id):
+        return None
+    return updated_at, expense_id
+
+
+def upsert_expense_rows(rows):
+    """
+    分批 upsert 记账记录, 返回成功写入的条数
+    某一批失败时仅对该批逐条重试, 单条失败只记录日志并跳过
+    """
+    written = 0
+    for i in range(0, len(rows), SYNC_BATCH_SIZE):
+        chunk = rows[i:i + SYNC_BATCH_SIZE]
+        try:
+            execute_with_retry(supabase.table('expenses').upsert(chunk, returning='minimal'))
+            written += len(chunk)
+            continue
+        except Exception as e:
+            app.logger.warning("Bulk upsert of %d expenses failed, retrying row by row: %s", len(chunk), e)
+
+        for expense_data in chunk:
+            try:
+                execute_with_retry(supabase.table('expenses').upsert(expense_data, returning='minimal'))
+                written += 1
+            except Exception as e:
+                app.logger.error("Error syncing expense %s: %s", expense_data['id'], e)
+    return written
+
+
+def sync_expense_rows(rows):
+    """
+    在服务端比较 updated_at 后批量 upsert, 返回 (写入条数, 冲突列表)
+    数据库未部署 sync_expenses 函数或函数调用失败时使用, 判断规则与该函数相同
+    """
+    written = 0
+    conflicts = []
+
+    # 一次查询取出所有已存在记录的所属用户和 updated_at, 代替逐条查询
+    # 数据库返回小写的 UUID, 客户端可能使用大写, 统一按小写比较
+    existing_rows = {}
+    expense_ids = [expense_data['id'] for expense_data in rows]
+    for i in range(0, len(expense_ids), SYNC_LOOKUP_BATCH_SIZE):
+        existing = execute_with_retry(supabase.table('expenses').select('id,user_id,updated_at').in_(
+            'id', expense_ids[i:i + SYNC_LOOKUP_BATCH_SIZE]
+        ))
+        existing_rows.update((str(row['id']).lower(), row) for row in existing.data)
+
+    rows_to_write = []
+    for expense_data in rows:
+        expense_id = expense_data['id']
+        cloud_row = existing_rows.get(str(expense_id).lower())
+        if cloud_row is None:
+            # 新记录
+            rows_to_write.append(expense_data)
+            continue
+
+        # 记录已存在，比较 updated_at 时间戳, 相同时保留云端版本并记为冲突
+        # 本地时间戳需超出云端 SYNC_CLOCK_SKEW 秒才算更新, 避免客户端时钟偏差覆盖较新的数据
+        # 记录属于其他用户或本地缺少 updated_at 时不覆盖, 同样记为冲突 (与数据库函数 sync_expenses 一致)
+        cloud_updated_at = cloud_row['updated_at']
+        local_updated_at = expense_data.get('updated_at')
+        if cloud_row['user_id'] != expense_data['user_id'] or local_updated_at is None:
+            is_newer = False
+        else:
+            try:
+                is_newer = (
+                    parse_timestamp(local_updated_at) - SYNC_CLOCK_SKEW
+                    > parse_timestamp(cloud_updated_at)
+                )
+            except Exception as e:
+                app.logger.error("Error syncing expense %s: %s", expense_id, e)
+                continue
+
+        if is_newer:
+            # 本地版本更新，更新云端
+            rows_to_write.append(expense_data)
+        else:
+            # 云端版本更新或相同，记录冲突
+            conflicts.append({
+                'id': expense_id,
+                'cloud_updated_at': cloud_updated_at,
+                'local_updated_at': local_updated_at
+            })
+
+    # 批量 upsert: 按字段组合分组, 保证每次写入的记录字段一致 (缺少的字段不会被置为 NULL)
+    rows_by_columns = {}
+    for expense_data in rows_to_write:
+        rows_by_columns.setdefault(frozenset(expense_data), []).append(expense_data)
+    for group in rows_by_columns.values():
+        written += upsert_expense_rows(group)
+    return written, conflicts
+
+
+def sync_expense_rows_rpc(user_id, rows):
+    """
+    调用数据库函数 sync_expenses 同步一批记录, 返回 (写入条数, 冲突列表)
+    比较 updated_at 和写入在数据库内完成, 已有记录加行锁, 并发同步不会互相覆盖
+    """
+    # 函数可能已经提交但响应丢失, 重放会把刚写入的记录报告为冲突, 因此只在请求确定没有执行时重试
+    result = execute_with_retry(supabase.rpc('sync_expenses', {
+        'p_user_id': user_id,
+        'p_expenses': rows,
+        'p_clock_skew_seconds': CONFIG.sync_clock_skew,
+    }), replay_safe=False)
+
+    local_updated_at = {expense_data['id']: expense_data.get('updated_at') for expense_data in rows}
+    written = 0
+    conflicts = []
+    for row in result.data:
+        if row['action'] == 'conflict':
+            conflicts.append({
+                'id': row['id'],
+                'cloud_updated_at': row['cloud_updated_at'],
+                'local_updated_at': local_updated_at.get(row['id'])
+            })
+        else:
+            written += 1
+    return written, conflicts
+
+
+def sync_expense_chunk(user_id, rows):
+    """
+    同步一批记录, 优先调用数据库函数, 失败时该批退回到服务端比较
+    数据库中没有该函数时记住结果, 之后不再尝试 (部署函数后需重启服务)
+    无法确定函数是否已经执行 (响应丢失或网关错误) 时不退回, 直接报错, 避免把刚写入的记录报告为冲突
+    """
+    global sync_rpc_available
+    if sync_rpc_available:
+        try:
+            return sync_expense_rows_rpc(user_id, rows)
+        except Exception as e:
+            if not is_db_error_not_executed(e):
+                raise
+            if getattr(e, 'code', None) in SYNC_RPC_MISSING_CODES:
+                sync_rpc_available = False
+                app.logger.warning("Database function sync_expenses not found, syncing in the app instead")
+            else:
+                app.logger.warning("sync_expenses RPC for %d expenses failed, falling back: %s", len(rows), e)
+    return sync_expense_rows(rows)
+
+
 @app.route('/api/expenses/sync', methods=['POST'])
 @require_auth
+@require_json
 def sync_expenses():
     """
     批量上传/同步记账数据到云端
@@ -879,7 +1936,7 @@ def sync_expenses():
     """
     try:
         data = request.json
-        if not data or 'expenses' not in data:
+        if 'expenses' not in data:
             return jsonify({
                 'status': 'error',
                 'message': '请求数据格式错误'
@@ -891,45 +1948,30 @@ def sync_expenses():
         uploaded_count = 0
         conflicts = []
 
+        # 验证必需字段, 同一 ID 出现多次时以最后一条为准
+        incoming = {}
         for expense_data in expenses:
-            try:
-                # 验证必需字段
-                required_fields = ['id', 'amount', 'title', 'category', 'expense_date']
-                if not all(field in expense_data for field in required_fields):
-                    continue
-
-                # 确保 user_id 匹配当前认证用户
-                expense_data['user_id'] = user_id
-
-                # 检查记录是否已存在
-                existing = supabase.table('expenses').select('*').eq('id', expense_data['id']).execute()
-
-                if existing.data and len(existing.data) > 0:
-                    # 记录已存在，比较 updated_at 时间戳
-                    existing_expense = existing.data[0]
-                    existing_updated_at = datetime.fromisoformat(existing_expense['updated_at'].replace('Z', '+00:00'))
-                    new_updated_at = datetime.fromisoformat(expense_data['updated_at'].replace('Z', '+00:00'))
-
-                    if new_updated_at > existing_updated_at:
-                        # 本地版本更新，更新云端
-                        supabase.table('expenses').update(expense_data).eq('id', expense_data['id']).execute()
-                        uploaded_count += 1
-                    else:
-                        # 云端版本更新或相同，记录冲突
-                        conflicts.append({
-                            'id': expense_data['id'],
-                            'cloud_updated_at': existing_expense['updated_at'],
-                            'local_updated_at': expense_data['updated_at']
-                        })
-                else:
-                    # 新记录，插入
-                    supabase.table('expenses').insert(expense_data).execute()
-                    uploaded_count += 1
+            if not isinstance(expense_data, dict) or not REQUIRED_EXPENSE_FIELDS.issubset(expense_data):
+                continue
 
-            except Exception as e:
-                print(f"Error syncing expense {expense_data.get('id')}: {str(e)}")
+            # id 不是合法 UUID 时跳过该条, 否则批量查询或数据库函数会因类型转换失败而整批出错
+            try:
+                uuid.UUID(str(expense_data['id']))
+            except ValueError:
+                app.logger.error("Error syncing expense %s: invalid id", expense_data['id'])
                 continue
 
+            # 确保 user_id 匹配当前认证用户
+            expense_data['user_id'] = user_id
+            incoming[expense_data['id']] = expense_data
+
+        # 按批同步, 优先由数据库函数完成比较和写入
+        rows = list(incoming.values())
+        for i in range(0, len(rows), SYNC_BATCH_SIZE):
+            written, chunk_conflicts = sync_expense_chunk(user_id, rows[i:i + SYNC_BATCH_SIZE])
+            uploaded_count += written
+            conflicts += chunk_conflicts
+
         return jsonify({
             'status': 'success',
             'message': f'成功同步 {uploaded_count} 条记录',
@@ -944,6 +1986,42 @@ def sync_expenses():
         }), 500
 
 
+def build_fetch_query(user_id, since, cursor, columns, limit=None):
+    """
+    构建拉取记账数据的查询: 按用户、since 和分页游标过滤, 按 (updated_at, id) 倒序
+    """
+    query = supabase.table('expenses').select(columns).eq('user_id', user_id)
+
+    # 如果提供了 since 参数，只获取该时间之后的记录
+    if since:
+        query = query.gte('updated_at', since)
+
+    # 游标分页: 只取排在上一页最后一条记录之后的数据, updated_at 相同时按 id 区分
+    if cursor:
+        cursor_updated_at, cursor_id = cursor
+        query = query.or_(
+            f'updated_at.lt."{cursor_updated_at}",'
+            f'and(updated_at.eq."{cursor_updated_at}",id.lt.{cursor_id})'
+        )
+
+    # 按更新时间排序, id 作为第二排序键保证分页顺序稳定
+    query = query.order('updated_at', desc=True).order('id', desc=True)
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
+def fetch_expenses_etag(user_id, rows):
+    """
+    拉取接口的 ETag: 由用户、查询参数和本次返回的每条记录的 (id, updated_at) 计算
+    返回范围内的记录新增、删除或修改 (updated_at 变化) 时都会改变
+    """
+    hasher = hashlib.blake2b(f"{user_id}:{request.query_string.decode()}".encode(), digest_size=16)
+    for row in rows:
+        hasher.update(f"\n{row['id']}:{row['updated_at']}".encode())
+    return hasher.hexdigest()
+
+
 @app.route('/api/expenses/fetch', methods=['GET'])
 @require_auth
 def fetch_expenses():
@@ -952,37 +2030,69 @@ def fetch_expenses():
 
     查询参数:
     - since: ISO8601 时间戳 (可选，仅获取此时间后的更新)
+    - limit: 每页条数 (可选, 最大 1000; 不传时一次返回全部)
+    - cursor: 上一页返回的 next_cursor (可选)
 
     返回:
     {
         "status": "success",
         "expenses": [...],
-        "server_time": "2025-01-14T12:00:00Z"
+        "server_time": "2025-01-14T12:00:00Z",
+        "next_cursor": "..."  // 还有下一页时非空
     }
+
+    响应带有 ETag, 请求头 If-None-Match 与之相同且数据未变化时返回 304 (无响应体)
     """
     try:
         user_id = request.user_id
         since = request.args.get('since')
 
-        # 构建查询
-        query = supabase.table('expenses').select('*').eq('user_id', user_id)
-
-        # 如果提供了 since 参数，只获取该时间之后的记录
-        if since:
-            query = query.gte('updated_at', since)
+        limit = request.args.get('limit')
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                limit = 0
+            if not 0 < limit <= FETCH_MAX_LIMIT:
+                return jsonify({
+                    'status': 'error',
+                    'message': f'limit 必须是 1 到 {FETCH_MAX_LIMIT} 之间的整数'
+                }), 400
 
-        # 按更新时间排序
-        query = query.order('updated_at', desc=True)
+        cursor = request.args.get('cursor')
+        if cursor:
+            cursor = decode_fetch_cursor(cursor)
+            if cursor is None:
+                return jsonify({
+                    'status': 'error',
+                    'message': '无效的 cursor 参数'
+                }), 400
+
+        # 客户端带有 If-None-Match 时先用一次轻量查询 (只取 id 和 updated_at, 可以只读索引) 判断数据是否变化
+        if request.if_none_match:
+            current = execute_with_retry(build_fetch_query(user_id, since, cursor, 'id,updated_at', limit))
+            etag = fetch_expenses_etag(user_id, current.data)
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+                response.set_etag(etag, weak=True)
+                return response
 
         # 执行查询
-        result = query.execute()
+        result = execute_with_retry(build_fetch_query(user_id, since, cursor, '*', limit))
 
-        return jsonify({
+        next_cursor = None
+        if limit and len(result.data) == limit:
+            next_cursor = encode_fetch_cursor(result.data[-1])
+
+        response = jsonify({
             'status': 'success',
             'expenses': result.data,
-            'server_time': datetime.utcnow().isoformat() + 'Z',
-            'count': len(result.data)
-        }), 200
+            'server_time': datetime.now(timezone.utc),
+            'count': len(result.data),
+            'next_cursor': next_cursor
+        })
+        response.set_etag(fetch_expenses_etag(user_id, result.data), weak=True)
+        return response
 
     except Exception as e:
         return jsonify({
@@ -993,6 +2103,7 @@ def fetch_expenses():
 
 @app.route('/api/expenses/<expense_id>', methods=['PUT'])
 @require_auth
+@require_json
 def update_expense(expense_id):
     """
     更新单条记账记录
@@ -1003,17 +2114,11 @@ def update_expense(expense_id):
         user_id = request.user_id
         data = request.json
 
-        if not data:
-            return jsonify({
-                'status': 'error',
-                'message': '请求数据为空'
-            }), 400
-
         # 确保 user_id 匹配
         data['user_id'] = user_id
 
         # 更新记录 (RLS 会自动确保只能更新自己的记录)
-        result = supabase.table('expenses').update(data).eq('id', expense_id).eq('user_id', user_id).execute()
+        result = execute_with_retry(supabase.table('expenses').update(data).eq('id', expense_id).eq('user_id', user_id))
 
         if not result.data:
             return jsonify({
@@ -1043,8 +2148,10 @@ def delete_expense(expense_id):
     try:
         user_id = request.user_id
 
-        # 删除记录 (RLS 会自动确保只能删除自己的记录)
-        result = supabase.table('expenses').delete().eq('id', expense_id).eq('user_id', user_id).execute()
+        # 删除记录 (RLS 会自动确保只能删除自己的记录), 不需要返回被删除的记录
+        execute_with_retry(
+            supabase.table('expenses').delete(returning='minimal').eq('id', expense_id).eq('user_id', user_id)
+        )
 
         return jsonify({
             'status': 'success',
@@ -1058,6 +2165,60 @@ def delete_expense(expense_id):
         }), 500
 
 
+@app.route('/api/expenses/delete_batch', methods=['POST'])
+@require_auth
+@require_json
+def delete_expenses_batch():
+    """
+    批量删除记账记录
+
+    请求体:
+    {
+        "ids": ["uuid", ...]  // 最多 500 个
+    }
+
+    返回:
+    {
+        "status": "success",
+        "deleted_count": 2
+    }
+    """
+    try:
+        user_id = request.user_id
+        ids = request.json.get('ids')
+
+        if (
+            not isinstance(ids, list)
+            or not 0 < len(ids) <= SYNC_BATCH_SIZE
+            or not all(isinstance(expense_id, str) and EXPENSE_ID_PATTERN.match(expense_id) for expense_id in ids)
+        ):
+            return jsonify({
+                'status': 'error',
+                'message': f'ids 必须是 1 到 {SYNC_BATCH_SIZE} 个记录 ID 组成的数组'
+            }), 400
+
+        # 按批删除 (ID 列表放在 URL 中), 只删除当前用户自己的记录
+        # 只需要删除条数, 由 PostgREST 返回计数而不返回被删除的记录
+        deleted_count = 0
+        for i in range(0, len(ids), SYNC_LOOKUP_BATCH_SIZE):
+            result = execute_with_retry(supabase.table('expenses').delete(count='exact', returning='minimal').in_(
+                'id', ids[i:i + SYNC_LOOKUP_BATCH_SIZE]
+            ).eq('user_id', user_id))
+            deleted_count += result.count or 0
+
+        return jsonify({
+            'status': 'success',
+            'message': f'成功删除 {deleted_count} 条记录',
+            'deleted_count': deleted_count
+        }), 200
+
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'删除失败: {str(e)}'
+        }), 500
+
+
 @app.route('/api/settings', methods=['GET'])
 @require_auth
 def get_settings():
@@ -1068,19 +2229,24 @@ def get_settings():
         user_id = request.user_id
 
         # 查询用户设置
-        result = supabase.table('user_settings').select('*').eq('user_id', user_id).execute()
+        result = execute_with_retry(supabase.table('user_settings').select('*').eq('user_id', user_id))
 
         if result.data and len(result.data) > 0:
             settings = result.data[0]
         else:
-            # 如果不存在，创建默认设置
+            # 如果不存在，创建默认设置 (新用户注册时数据库触发器已创建, 这里只兜底早期用户)
+            # 并发请求同时创建时, 冲突的一方不插入也不报错, 改为读取已创建的记录
             default_settings = {
                 'user_id': user_id,
                 'categories': [],
                 'currency': 'CNY',
                 'theme': 'system'
             }
-            result = supabase.table('user_settings').insert(default_settings).execute()
+            result = execute_with_retry(supabase.table('user_settings').upsert(
+                default_settings, on_conflict='user_id', ignore_duplicates=True
+            ))
+            if not result.data:
+                result = execute_with_retry(supabase.table('user_settings').select('*').eq('user_id', user_id))
             settings = result.data[0]
 
         return jsonify({
@@ -1097,6 +2263,7 @@ def get_settings():
 
 @app.route('/api/settings', methods=['POST'])
 @require_auth
+@require_json
 def update_settings():
     """
     更新用户设置
@@ -1112,17 +2279,11 @@ def update_settings():
         user_id = request.user_id
         data = request.json
 
-        if not data:
-            return jsonify({
-                'status': 'error',
-                'message': '请求数据为空'
-            }), 400
-
         # 确保 user_id
         data['user_id'] = user_id
 
-        # 尝试更新，如果不存在则插入
-        result = supabase.table('user_settings').upsert(data).eq('user_id', user_id).execute()
+        # 按 user_id 冲突时更新，不存在则插入 (单条 INSERT ... ON CONFLICT DO UPDATE)
+        result = execute_with_retry(supabase.table('user_settings').upsert(data, on_conflict='user_id'))
 
         return jsonify({
             'status': 'success',
@@ -1138,12 +2299,10 @@ def update_settings():
 
 
 if __name__ == '__main__':
-    # 从环境变量读取端口,如果没有则使用默认值 5001
-    port = int(os.getenv('PORT', '5001'))
-
-    # 开发环境运行
+    # 开发环境运行 (多线程), 生产环境请使用 gunicorn -c gunicorn.conf.py wsgi:app
+    # 需要协程并发时设置 GUNICORN_WORKER_CLASS=gevent, 由 gunicorn 负责 monkey-patch, 不在此处引入 gevent
     app.run(
-        host='0.0.0.0',  # 允许外部访问
-        port=port,       # 从环境变量读取的端口
-        debug=True       # 调试模式
+        host='0.0.0.0',      # 允许外部访问
+        port=CONFIG.port,    # 从环境变量 PORT 读取的端口, 默认 5001
+        debug=CONFIG.debug   # 调试模式需通过 FLASK_DEBUG=1 显式开启
     )
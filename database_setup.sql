@@ -17,7 +17,10 @@ CREATE TABLE IF NOT EXISTS expenses (
 );
 
 -- Create indexes for better query performance
-CREATE INDEX IF NOT EXISTS idx_expenses_user_id ON expenses(user_id);
+-- Composite index matching /api/expenses/fetch (WHERE user_id = ? ORDER BY updated_at DESC, id DESC),
+-- so pages are read in index order without a sort; it also serves plain user_id lookups
+CREATE INDEX IF NOT EXISTS idx_expenses_user_updated_at ON expenses(user_id, updated_at DESC, id DESC);
+DROP INDEX IF EXISTS idx_expenses_user_id;
 CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses(expense_date);
 CREATE INDEX IF NOT EXISTS idx_expenses_created_at ON expenses(created_at);
 CREATE INDEX IF NOT EXISTS idx_expenses_updated_at ON expenses(updated_at);
@@ -123,7 +126,75 @@ CREATE TRIGGER on_auth_user_created
     EXECUTE FUNCTION handle_new_user();
 
 -- ==========================================
--- 6. Grant necessary permissions
+-- 6. Create function for batch sync (last-write-wins)
+-- ==========================================
+-- Used by /api/expenses/sync: compares updated_at and writes each expense inside the
+-- database with the existing row locked, so concurrent syncs cannot overwrite each other.
+-- Keys missing from an incoming expense keep their current value.
+-- Returns one row per expense, action is 'inserted', 'updated' or 'conflict'.
+CREATE OR REPLACE FUNCTION sync_expenses(
+    p_user_id UUID,
+    p_expenses JSONB,
+    p_clock_skew_seconds DOUBLE PRECISION DEFAULT 0
+)
+RETURNS TABLE (id TEXT, action TEXT, cloud_updated_at TIMESTAMP WITH TIME ZONE) AS $$
+DECLARE
+    item JSONB;
+    existing expenses;
+    merged expenses;
+BEGIN
+    FOR item IN SELECT value FROM jsonb_array_elements(p_expenses) LOOP
+        item := item || jsonb_build_object('user_id', p_user_id);
+        id := item->>'id';
+        cloud_updated_at := NULL;
+
+        SELECT * INTO existing FROM expenses e WHERE e.id = (item->>'id')::uuid FOR UPDATE;
+
+        IF NOT FOUND THEN
+            merged := jsonb_populate_record(NULL::expenses, item);
+            INSERT INTO expenses
+            VALUES (
+                merged.id, merged.user_id, merged.amount, merged.title, merged.category,
+                merged.expense_date, merged.notes,
+                COALESCE(merged.created_at, NOW()), COALESCE(merged.updated_at, NOW())
+            )
+            ON CONFLICT ON CONSTRAINT expenses_pkey DO NOTHING;
+
+            IF FOUND THEN
+                action := 'inserted';
+            ELSE
+                -- Another sync inserted the same id first
+                action := 'conflict';
+                SELECT e.updated_at INTO cloud_updated_at FROM expenses e WHERE e.id = merged.id;
+            END IF;
+        ELSIF existing.user_id = p_user_id
+            AND (item->>'updated_at')::timestamptz - make_interval(secs => p_clock_skew_seconds) > existing.updated_at THEN
+            merged := jsonb_populate_record(existing, item);
+            UPDATE expenses e
+            SET amount = merged.amount,
+                title = merged.title,
+                category = merged.category,
+                expense_date = merged.expense_date,
+                notes = merged.notes,
+                created_at = merged.created_at,
+                updated_at = merged.updated_at
+            WHERE e.id = existing.id;
+            action := 'updated';
+        ELSE
+            action := 'conflict';
+            cloud_updated_at := existing.updated_at;
+        END IF;
+
+        RETURN NEXT;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Only the backend (service role) may call it, p_user_id is not checked against auth.uid()
+REVOKE EXECUTE ON FUNCTION sync_expenses(UUID, JSONB, DOUBLE PRECISION) FROM PUBLIC, anon, authenticated;
+
+-- ==========================================
+-- 7. Grant necessary permissions
 -- ==========================================
 -- Service role has full access by default
 -- Authenticated users access is controlled by RLS policies
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+Gunicorn 配置
+生产环境启动: gunicorn -c gunicorn.conf.py wsgi:app
+协程模式: GUNICORN_WORKER_CLASS=gevent gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+import multiprocessing
+import os
+
+# 监听地址, 端口与开发服务器保持一致
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+
+# 默认使用线程 worker: 请求主要在等待 Supabase / DashScope 的网络 I/O, 多线程可以重叠这些等待
+# 设置 GUNICORN_WORKER_CLASS=gevent (需额外安装 gevent) 可改用协程 worker,
+# gunicorn 会在加载应用前自动 monkey-patch 标准库, 单个 worker 可同时处理大量慢请求
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+# 进程数默认 2 * CPU + 1
+workers = int(os.getenv('GUNICORN_WORKERS', 2 * multiprocessing.cpu_count() + 1))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+# gevent worker 每个进程的最大并发连接数
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '200'))
+
+# 在 master 进程中预先加载应用 (依赖库、Supabase / DashScope 客户端只初始化一次),
+# worker 通过 fork 以写时复制方式共享这部分内存; 应用导入时不会建立连接或启动线程
+# gevent worker 需要在导入应用前 monkey-patch, 因此不预加载
+preload_app = os.getenv('GUNICORN_PRELOAD', '0' if worker_class == 'gevent' else '1') == '1'
+
+# 语音解析可能需要较长时间
+timeout = 120
+# 保持客户端 / 负载均衡器的 keep-alive 连接, 避免每个请求重新建立 TCP 连接
+keepalive = 5
+
+# worker 心跳文件放在内存文件系统, 避免磁盘 I/O
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
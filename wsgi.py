@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""
+WSGI 入口
+gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+from app import app